@@ -0,0 +1,197 @@
+"""
+
+In-process replacement for gEAR's add_ensembl_id_to_h5ad_missing_release.py and
+find_best_ensembl_release_from_h5ad.py.
+
+Each organism's gene annotation table (every Ensembl release gEAR knows about) is read
+from the gEAR database the first time it's needed and kept for the rest of the run, so
+mapping a dataset is a pandas join on an AnnData that's already in memory instead of a
+fresh interpreter, scanpy import, database read and H5AD rewrite.
+
+    mapper = ensembl_mapper.get_mapper(cache_dir)
+    adata, release = mapper.map_to_ensembl(adata, organism_id)
+
+Picking the best release is cached on disk in cache_dir, if one is given:
+
+  * release_cache.sqlite remembers the release chosen for each gene set, keyed by organism
+    and a hash of the sorted gene identifiers.  Bundles from the same lab and pipeline
+    share gene lists, so repeats resolve without touching the annotations at all.
+  * <organism>.<column>.npz is an inverted index of gene -> releases (a boolean
+    gene x release matrix).  On a fingerprint miss, scoring every release is one indexed
+    lookup and a column sum.  It is rebuilt from the database once it's a week old, and
+    since the fingerprint key includes the index's release list, new releases invalidate
+    old fingerprints.
+
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+
+# gEAR library, on PYTHONPATH alongside gear.metadata
+import geardb
+
+# Inverted indexes older than this are rebuilt from the database
+INDEX_MAX_AGE = 7 * 24 * 60 * 60
+
+
+class EnsemblMapper:
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        self.annotations = dict()
+        self.release_indexes = dict()
+        self.lock = threading.Lock()
+        self.release_cache = None
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self.release_cache = sqlite3.connect(os.path.join(cache_dir, "release_cache.sqlite"),
+                                                 timeout=60, check_same_thread=False)
+            with self.release_cache:
+                self.release_cache.execute(
+                    "CREATE TABLE IF NOT EXISTS best_release ("
+                    "organism_id INTEGER NOT NULL, id_column TEXT NOT NULL, fingerprint TEXT NOT NULL, "
+                    "ensembl_release INTEGER NOT NULL, PRIMARY KEY (organism_id, id_column, fingerprint))")
+
+    def get_annotations(self, organism_id):
+        """
+        Output: DataFrame of ensembl_id, gene_symbol, ensembl_release for every release of
+               the organism.  Loaded from the database once and then cached.
+        """
+        with self.lock:
+            if organism_id not in self.annotations:
+                self.annotations[organism_id] = _load_annotations(organism_id)
+            return self.annotations[organism_id]
+
+    def best_release(self, organism_id, genes, column='ensembl_id'):
+        """
+        Input: A gEAR organism ID and the dataset's gene identifiers, which are matched
+               against the annotation column given (ensembl_id or gene_symbol).
+
+        Output: The Ensembl release sharing the most genes with the dataset.  Ties go to
+               the newest release.
+        """
+        genes = pd.Index(genes).astype(str)
+        if column == 'gene_symbol':
+            genes = genes.str.upper()
+        gene_index, releases, matrix = self.get_release_index(organism_id, column)
+
+        digest = hashlib.sha1()
+        digest.update(",".join(str(r) for r in releases).encode())
+        for gene in sorted(set(genes)):
+            digest.update(b"\n" + gene.encode())
+        fingerprint = digest.hexdigest()
+
+        with self.lock:
+            if self.release_cache:
+                row = self.release_cache.execute(
+                    "SELECT ensembl_release FROM best_release WHERE organism_id = ? AND id_column = ? AND fingerprint = ?",
+                    (organism_id, column, fingerprint)).fetchone()
+                if row:
+                    return row[0]
+
+        rows = gene_index.get_indexer(genes.unique())
+        rows = rows[rows >= 0]
+        if not len(rows):
+            raise Exception("No genes matched any Ensembl release for organism {0}".format(organism_id))
+        counts = matrix[rows].sum(axis=0)
+        release = int(releases[len(counts) - 1 - np.argmax(counts[::-1])])
+
+        with self.lock:
+            if self.release_cache:
+                with self.release_cache:
+                    self.release_cache.execute(
+                        "INSERT OR REPLACE INTO best_release (organism_id, id_column, fingerprint, ensembl_release) VALUES (?, ?, ?, ?)",
+                        (organism_id, column, fingerprint, release))
+        return release
+
+    def get_release_index(self, organism_id, column):
+        """
+        Output: (gene Index, sorted release array, boolean gene x release matrix) for the
+               organism, keyed on the annotation column given.  Held in memory, and in
+               cache_dir between runs.
+        """
+        key = (organism_id, column)
+        with self.lock:
+            if key in self.release_indexes:
+                return self.release_indexes[key]
+
+        index_path = None
+        if self.cache_dir:
+            index_path = os.path.join(self.cache_dir, "{0}.{1}.npz".format(organism_id, column))
+        if index_path and os.path.isfile(index_path) and time.time() - os.path.getmtime(index_path) < INDEX_MAX_AGE:
+            with np.load(index_path) as npz:
+                release_index = (pd.Index(npz['genes']), npz['releases'], npz['matrix'])
+        else:
+            release_index = self._build_release_index(organism_id, column)
+            if index_path:
+                tmp_path = "{0}.{1}.tmp.npz".format(index_path[:-4], os.getpid())
+                np.savez(tmp_path, genes=release_index[0].values.astype(str),
+                         releases=release_index[1], matrix=release_index[2])
+                os.replace(tmp_path, index_path)
+
+        with self.lock:
+            self.release_indexes[key] = release_index
+        return release_index
+
+    def _build_release_index(self, organism_id, column):
+        annotations = self.get_annotations(organism_id)
+        keys = annotations['symbol_key'] if column == 'gene_symbol' else annotations[column].astype(str)
+        gene_codes, genes = pd.factorize(keys)
+        release_codes, releases = pd.factorize(annotations['ensembl_release'], sort=True)
+        matrix = np.zeros((len(genes), len(releases)), dtype=bool)
+        matrix[gene_codes, release_codes] = True
+        return pd.Index(genes), np.asarray(releases, dtype=int), matrix
+
+    def map_to_ensembl(self, adata, organism_id, symbol_column='gene_symbol'):
+        """
+        Input: An AnnData indexed on gene symbols (or with a gene_symbol column in var) and
+               a gEAR organism ID.
+
+        Output: (adata, release).  The returned AnnData is re-indexed on Ensembl IDs from the
+               best-matching release with the original symbols kept in var['gene_symbol'].
+               Genes with no Ensembl ID in that release are dropped, as are all but the first
+               gene mapping to the same Ensembl ID.
+        """
+        if symbol_column in adata.var.columns:
+            symbols = adata.var[symbol_column].astype(str)
+        else:
+            symbols = pd.Series(adata.var.index.astype(str), index=adata.var.index)
+        release = self.best_release(organism_id, symbols, column='gene_symbol')
+
+        annotations = self.get_annotations(organism_id)
+        release_annot = annotations.loc[annotations['ensembl_release'] == release]
+        lookup = release_annot.drop_duplicates('symbol_key').set_index('symbol_key')['ensembl_id']
+
+        ensembl_ids = pd.Series(symbols.str.upper().map(lookup).values)
+        keep = ensembl_ids.notna() & ~ensembl_ids.duplicated()
+        mapped = adata[:, keep.values].copy()
+        mapped.var[symbol_column] = symbols.values[keep.values]
+        mapped.var.index = pd.Index(ensembl_ids[keep].values, name=None)
+        return mapped, release
+
+def _load_annotations(organism_id):
+    cnx = geardb.Connection()
+    cursor = cnx.get_cursor()
+    query = "SELECT ensembl_id, gene_symbol, ensembl_release FROM gene WHERE organism_id = %s"
+    cursor.execute(query, (organism_id,))
+    annotations = pd.DataFrame(cursor.fetchall(), columns=['ensembl_id', 'gene_symbol', 'ensembl_release'])
+    cursor.close()
+    cnx.close()
+
+    annotations['ensembl_release'] = annotations['ensembl_release'].astype(int)
+    annotations['symbol_key'] = annotations['gene_symbol'].astype(str).str.upper()
+    return annotations
+
+# One mapper per process, so every dataset a worker handles shares the loaded tables
+_mapper = None
+
+def get_mapper(cache_dir=None):
+    global _mapper
+    if _mapper is None:
+        _mapper = EnsemblMapper(cache_dir)
+    return _mapper
@@ -0,0 +1,94 @@
+"""
+
+Groups per-object Cloud Storage calls (deletes, metadata reloads) into batch requests.
+
+Each blob.delete() or blob.reload() is normally its own HTTP round trip.  Inside a
+client.batch() context they are collected and sent as one multipart request of up to
+MAX_BATCH calls, which is what this module does for whole lists of blobs.
+
+    gcs_batch.reload_blobs(sclient, blobs)   # returns the blobs that exist, properties filled in
+    gcs_batch.delete_blobs(sclient, blobs)
+
+    deleter = gcs_batch.BatchDeleter(sclient)
+    deleter.delete(blob)      # queued; sent once a window's worth has built up
+    deleter.flush()           # send whatever is left
+
+If a batch fails as a whole (one missing object fails it with some client versions) its
+calls are retried one at a time, so a NotFound only affects its own blob.
+
+"""
+
+import threading
+
+from google.api_core.exceptions import NotFound
+
+# Most calls GCS accepts in one batch request
+MAX_BATCH = 100
+
+
+def delete_blobs(sclient, blobs):
+    """Delete the blobs, MAX_BATCH per request.  Blobs that are already gone are ignored."""
+    for chunk in _chunks(blobs, MAX_BATCH):
+        try:
+            with sclient.batch():
+                for blob in chunk:
+                    blob.delete()
+        except Exception:
+            for blob in chunk:
+                try:
+                    blob.delete()
+                except NotFound:
+                    pass
+
+def reload_blobs(sclient, blobs):
+    """
+    Input: A storage client and blobs made with bucket.blob() (no properties yet).
+
+    Output: The blobs that exist, with their properties (size, crc32c, updated...) loaded,
+           MAX_BATCH reloads per request.
+    """
+    found = list()
+    for chunk in _chunks(blobs, MAX_BATCH):
+        try:
+            with sclient.batch():
+                for blob in chunk:
+                    blob.reload()
+            found.extend(chunk)
+        except Exception:
+            for blob in chunk:
+                try:
+                    blob.reload()
+                    found.append(blob)
+                except NotFound:
+                    pass
+    return found
+
+class BatchDeleter:
+    """
+    Collects blobs to delete from any number of threads and deletes them (in batch
+    requests of up to MAX_BATCH) once window of them have built up, and on flush().
+    """
+    def __init__(self, sclient, window=MAX_BATCH):
+        self.sclient = sclient
+        self.window = window
+        self.pending = list()
+        self.lock = threading.Lock()
+
+    def delete(self, blob):
+        with self.lock:
+            self.pending.append(blob)
+            if len(self.pending) < self.window:
+                return
+            blobs, self.pending = self.pending, list()
+        delete_blobs(self.sclient, blobs)
+
+    def flush(self):
+        with self.lock:
+            blobs, self.pending = self.pending, list()
+        if blobs:
+            delete_blobs(self.sclient, blobs)
+
+def _chunks(items, size):
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -0,0 +1,148 @@
+"""
+
+Checksum-verified, concurrent uploads to a Google Cloud Storage bucket.
+
+Small files go up as a single chunked (resumable) upload.  Files over the composite
+threshold are split into parts which are uploaded in parallel as temporary objects and
+then composed into the final object server-side.  Every finished object's CRC32C is
+compared with one computed from the local file, and a mismatch is an error.
+
+A composite upload that fails deletes the parts it had sent.  One that was interrupted
+(the process killed) resumes: a part that already exists in the bucket with the right
+CRC32C is not sent again, so re-running the upload only transfers the missing parts.  Any
+other parts under the object's name, such as those of an older version of the file split
+differently, are deleted before the upload starts.
+
+Only a small part of the bucket/blob API is used (blob(), get_blob(), list_blobs(),
+upload_from_file(), compose(), reload(), delete()), so this runs unchanged against a local fake-GCS server.
+Set STORAGE_EMULATOR_HOST (e.g. http://localhost:4443 for fsouza/fake-gcs-server) and the
+storage client will talk to it instead of Google.
+
+"""
+
+import base64
+import concurrent.futures
+import contextlib
+import os
+
+import google_crc32c
+from google.cloud.storage.retry import DEFAULT_RETRY
+
+# Resumable uploads send the data in chunks of this size, and a transient failure retries
+# from the last committed chunk rather than from the start of the file.  Must be a multiple of 256 KB.
+CHUNK_SIZE = 32 * 1024 * 1024
+# Files at least this big are uploaded as parallel parts and composed
+COMPOSITE_THRESHOLD = 256 * 1024 * 1024
+PART_SIZE = 128 * 1024 * 1024
+# GCS can compose at most 32 source objects in one request
+MAX_PARTS = 32
+READ_SIZE = 8 * 1024 * 1024
+
+
+class Uploader:
+    def __init__(self, bucket, workers=4, part_size=PART_SIZE, composite_threshold=COMPOSITE_THRESHOLD):
+        self.bucket = bucket
+        self.part_size = part_size
+        self.composite_threshold = composite_threshold
+        # Datasets are submitted to one pool and their parts go to another, so a dataset
+        # waiting on its parts never starves the part uploads of threads.
+        self.dataset_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.part_pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, paths, timer=None):
+        """
+        Queue a dataset's files for upload and return a future for the list of blobs.  The
+        files are sent one after another in the given order, so the file the processor
+        watches for (the H5AD) should come last.
+
+        timer is an optional context manager (e.g. ingest_metrics.Recorder.stage()) entered
+        around the upload once a worker picks it up, so time spent queued isn't counted.
+        """
+        return self.dataset_pool.submit(self._upload_all, paths, timer)
+
+    def shutdown(self):
+        self.dataset_pool.shutdown(wait=True)
+        self.part_pool.shutdown(wait=True)
+
+    def _upload_all(self, paths, timer=None):
+        with timer or contextlib.nullcontext():
+            return [self.upload_file(path) for path in paths]
+
+    def upload_file(self, path, blob_name=None):
+        """
+        Upload one file, named after its basename unless blob_name is given, and verify
+        its CRC32C.  Returns the blob.
+        """
+        blob_name = blob_name or os.path.basename(path)
+        size = os.path.getsize(path)
+        if size >= self.composite_threshold:
+            blob = self._upload_composite(path, blob_name, size)
+        else:
+            blob = self.bucket.blob(blob_name, chunk_size=CHUNK_SIZE)
+            with open(path, 'rb') as fh:
+                blob.upload_from_file(fh, size=size, checksum="crc32c", retry=DEFAULT_RETRY)
+        verify_crc32c(blob, file_crc32c(path))
+        return blob
+
+    def _upload_composite(self, path, blob_name, size):
+        part_size = max(self.part_size, -(-size // MAX_PARTS))
+        ranges = [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+        part_names = ["{0}.part-{1:03d}-of-{2:03d}".format(blob_name, i + 1, len(ranges))
+                      for i in range(len(ranges))]
+
+        self._delete_parts(blob_name, keep=part_names)
+
+        futures = [self.part_pool.submit(self._upload_part, path, name, offset, length)
+                   for name, (offset, length) in zip(part_names, ranges)]
+        try:
+            parts = [future.result() for future in futures]
+            blob = self.bucket.blob(blob_name)
+            blob.compose(parts)
+        except:
+            # Let the other parts finish before deleting, so none is left orphaned in the bucket
+            concurrent.futures.wait(futures)
+            self._delete_parts(blob_name)
+            raise
+        for part in parts:
+            part.delete()
+        return blob
+
+    def _delete_parts(self, blob_name, keep=()):
+        """Delete the blob's temporary part objects, other than those named in keep."""
+        for part in self.bucket.list_blobs(prefix="{0}.part-".format(blob_name)):
+            if part.name not in keep:
+                part.delete()
+
+    def _upload_part(self, path, part_name, offset, length):
+        crc = file_crc32c(path, offset, length)
+        existing = self.bucket.get_blob(part_name)
+        if existing is not None and existing.crc32c == crc:
+            # Left behind by an interrupted upload and still good
+            return existing
+
+        part = self.bucket.blob(part_name, chunk_size=CHUNK_SIZE)
+        with open(path, 'rb') as fh:
+            fh.seek(offset)
+            part.upload_from_file(fh, size=length, checksum="crc32c", retry=DEFAULT_RETRY)
+        verify_crc32c(part, crc)
+        return part
+
+def file_crc32c(path, offset=0, length=None):
+    """Base64-encoded CRC32C of a file (or a byte range of it), as GCS reports it."""
+    checksum = google_crc32c.Checksum()
+    with open(path, 'rb') as fh:
+        fh.seek(offset)
+        remaining = length if length is not None else os.path.getsize(path) - offset
+        while remaining > 0:
+            chunk = fh.read(min(READ_SIZE, remaining))
+            if not chunk:
+                break
+            checksum.update(chunk)
+            remaining -= len(chunk)
+    return base64.b64encode(checksum.digest()).decode('ascii')
+
+def verify_crc32c(blob, expected):
+    blob.reload()
+    if blob.crc32c != expected:
+        raise Exception("CRC32C mismatch for gs://{0}/{1}: bucket has {2}, local file is {3}".format(
+            blob.bucket.name, blob.name, blob.crc32c, expected))
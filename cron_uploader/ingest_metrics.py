@@ -0,0 +1,200 @@
+"""
+
+Per-stage timing and resource use for nemo_upload_crawler.py and nemo_gcloud_processor.py.
+
+Each stage of each dataset (extract, read, write, upload, download...) is timed with a
+context manager which records:
+
+    wall_s        elapsed time
+    cpu_s         CPU time (user + system) of the whole process, so helper threads such
+                  as parallelgzip's inflaters count, as do other datasets' stages running
+                  in the same process at the time
+    thread_cpu_s  CPU time of the thread running the stage
+    peak_rss_mb   the process's peak resident set size as of the end of the stage
+    read_bytes, write_bytes   bytes the process read from/wrote to storage (/proc/self/io)
+    rchar, wchar  bytes passed through read()/write() calls, page-cache hits and sockets included
+
+The I/O counters are only there on Linux, and like cpu_s they are process wide.
+
+    metrics = ingest_metrics.Metrics('/path/to/run.metrics.jsonl')
+    with metrics.stage(dataset_id, 'extract'):
+        ...
+    metrics.add(records)            # the .records of a Recorder used in a worker process
+    for line in metrics.summary():
+        log('INFO', line)
+    metrics.close()
+
+Metrics writes every record as a JSON line as it comes in and keeps them for the
+end-of-run summary of percentiles per stage.  A Recorder only collects them, for code
+running in worker processes that hands its records back to the parent.
+
+With a profile directory, profiled() dumps a cProfile of the code it wraps to
+<profile_dir>/<name>.prof, and Metrics.prune_profiles() then keeps only those of the
+slowest datasets.
+
+"""
+
+import contextlib
+import cProfile
+import datetime
+import json
+import math
+import os
+import resource
+import threading
+import time
+
+PERCENTILES = [50, 90, 99]
+IO_FIELDS = ['read_bytes', 'write_bytes', 'rchar', 'wchar']
+
+
+class Recorder:
+    def __init__(self):
+        self.records = list()
+        self.lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def stage(self, dataset_id, name):
+        """Time the wrapped code as stage 'name' of a dataset.  Exceptions are recorded (ok=False) and re-raised."""
+        start = _sample()
+        ok = False
+        try:
+            yield
+            ok = True
+        finally:
+            self._record(_entry(dataset_id, name, start, _sample(), ok))
+
+    def _record(self, entry):
+        with self.lock:
+            self.records.append(entry)
+
+class Metrics(Recorder):
+    def __init__(self, path=None, profile_dir=None, profile_top=0):
+        """
+        Input: Optionally a JSON-lines file to append the records to, and the directory
+               profiled() wrote to with how many of the slowest datasets' profiles to keep.
+        """
+        super().__init__()
+        self.fh = open(path, 'a') if path else None
+        self.profile_dir = profile_dir
+        self.profile_top = profile_top
+
+    def add(self, records):
+        """Take in records collected elsewhere (e.g. a worker process's Recorder)."""
+        for entry in records:
+            self._record(entry)
+
+    def close(self):
+        if self.fh:
+            self.fh.close()
+            self.fh = None
+
+    def summary(self):
+        """
+        Output: One line per stage, in the order stages were first seen, giving the count,
+               failures, wall time percentiles and max, total CPU, the highest peak RSS and
+               total storage I/O.
+        """
+        stages = dict()
+        with self.lock:
+            for entry in self.records:
+                stages.setdefault(entry['stage'], list()).append(entry)
+
+        lines = list()
+        for name, entries in stages.items():
+            walls = sorted(e['wall_s'] for e in entries)
+            percentiles = " ".join("p{0}={1:.2f}s".format(p, percentile(walls, p)) for p in PERCENTILES)
+            lines.append("{0}: n={1} failed={2} wall {3} max={4:.2f}s cpu={5:.1f}s peak_rss={6:.0f}MB read={7:.1f}MB written={8:.1f}MB".format(
+                name, len(entries), sum(1 for e in entries if not e['ok']), percentiles, walls[-1],
+                sum(e['cpu_s'] for e in entries), max(e['peak_rss_mb'] for e in entries),
+                sum(e.get('read_bytes') or 0 for e in entries) / 1024 ** 2,
+                sum(e.get('write_bytes') or 0 for e in entries) / 1024 ** 2))
+        return lines
+
+    def prune_profiles(self):
+        """
+        Keep the profiles of the profile_top datasets with the most wall time this run and
+        remove the rest of this run's.  Returns the dataset IDs kept.
+        """
+        if not self.profile_dir:
+            return []
+        totals = dict()
+        with self.lock:
+            for entry in self.records:
+                totals[entry['dataset_id']] = totals.get(entry['dataset_id'], 0) + entry['wall_s']
+        keep = sorted(totals, key=totals.get, reverse=True)[:self.profile_top]
+        for filename in os.listdir(self.profile_dir):
+            dataset_id = filename.split('.')[0]
+            if filename.endswith('.prof') and dataset_id in totals and dataset_id not in keep:
+                os.remove(os.path.join(self.profile_dir, filename))
+        return keep
+
+    def _record(self, entry):
+        with self.lock:
+            self.records.append(entry)
+            if self.fh:
+                self.fh.write(json.dumps(entry) + "\n")
+                self.fh.flush()
+
+@contextlib.contextmanager
+def profiled(profile_dir, name):
+    """
+    Profile the wrapped code into <profile_dir>/<name>.prof.  Does nothing without a
+    profile_dir, or if another profiler is already running in this process (Python 3.12+
+    allows only one at a time).
+    """
+    profiler = None
+    if profile_dir:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            profiler = None
+    try:
+        yield
+    finally:
+        if profiler:
+            profiler.disable()
+            os.makedirs(profile_dir, exist_ok=True)
+            profiler.dump_stats(os.path.join(profile_dir, "{0}.prof".format(name)))
+
+def percentile(values, p):
+    """Nearest-rank percentile of sorted values."""
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values), math.ceil(p / 100 * len(values))) - 1)]
+
+def _sample():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return {
+        'wall': time.perf_counter(),
+        'cpu': usage.ru_utime + usage.ru_stime,
+        'thread_cpu': time.thread_time(),
+        'io': _read_io(),
+    }
+
+def _entry(dataset_id, name, start, end, ok):
+    entry = {
+        'time': datetime.datetime.now().isoformat(timespec='seconds'),
+        'pid': os.getpid(),
+        'dataset_id': dataset_id,
+        'stage': name,
+        'ok': ok,
+        'wall_s': round(end['wall'] - start['wall'], 4),
+        'cpu_s': round(end['cpu'] - start['cpu'], 4),
+        'thread_cpu_s': round(end['thread_cpu'] - start['thread_cpu'], 4),
+        # ru_maxrss is in kilobytes on Linux
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+    }
+    for field in IO_FIELDS:
+        if field in start['io'] and field in end['io']:
+            entry[field] = end['io'][field] - start['io'][field]
+    return entry
+
+def _read_io():
+    try:
+        with open('/proc/self/io') as fh:
+            fields = dict(line.split(':', 1) for line in fh if ':' in line)
+    except OSError:
+        return {}
+    return {k: int(v) for k, v in fields.items() if k in IO_FIELDS}
@@ -0,0 +1,302 @@
+"""
+
+Durable record of what nemo_upload_crawler.py has already done with each bundle.
+
+Bundles are keyed on (source path, size, mtime) so a bundle that is replaced in place
+gets a fresh record while an untouched one keeps its dataset ID across runs.  Each record
+remembers the last pipeline stage that completed:
+
+    pending -> extracted -> converted -> mapped -> uploaded
+
+so a re-run can skip finished bundles and pick partial ones back up where they stopped.
+
+Records also carry the bundle's MD5, which makes the table a content-addressed index of
+what has been produced: find_content() turns up an earlier bundle with identical bytes
+(the same bundle under another path or version name), whose H5AD/JSON or upload can be
+reused instead of converting again.  While a bundle is being converted its MD5 is
+claimed in content_claims (one row per MD5, naming the bundle and the crawler run), so a
+worker that picks up a byte-identical bundle at the same time waits for it rather than
+converting the same content under a second dataset ID.
+
+The store is a local SQLite file.  Every worker process opens its own connection; SQLite's
+locking serializes the (tiny) writes.
+
+The same file keeps the high-water marks of incremental database discovery (the largest
+derived-table key seen by the last nemo_upload_crawler.py -db --incremental run) and the
+snapshot of the DMZ inventory manifest (bundle path -> size, mtime) that
+--manifest_diff compares each new manifest against.
+
+ProcessedIndex is the lighter-weight view used by the bundle-log discovery mode: the set
+of bundle paths already written to the crawler's tracking log, read in full when it is built.
+
+"""
+
+import datetime
+import hashlib
+import os
+import sqlite3
+import uuid
+
+STAGES = ['pending', 'extracted', 'converted', 'mapped', 'uploaded']
+
+# Bytes read at a time when hashing a bundle
+HASH_CHUNK = 8 * 1024 * 1024
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS bundles (
+    source_path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    md5 TEXT,
+    dataset_id TEXT NOT NULL,
+    stage TEXT NOT NULL,
+    is_en INTEGER,
+    h5ad_path TEXT,
+    json_path TEXT,
+    error TEXT,
+    updated TEXT NOT NULL,
+    PRIMARY KEY (source_path, size, mtime)
+);
+CREATE INDEX IF NOT EXISTS bundles_md5 ON bundles (md5);
+CREATE TABLE IF NOT EXISTS content_claims (
+    md5 TEXT PRIMARY KEY,
+    source_path TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    mtime INTEGER NOT NULL,
+    run_id TEXT NOT NULL,
+    updated TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS manifest_snapshot (
+    path TEXT PRIMARY KEY,
+    size INTEGER,
+    mtime TEXT
+);
+CREATE TABLE IF NOT EXISTS discovery_marks (
+    source TEXT PRIMARY KEY,
+    mark,
+    updated TEXT NOT NULL
+);
+"""
+
+
+class IngestState:
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.conn = sqlite3.connect(db_path, timeout=60)
+        self.conn.row_factory = sqlite3.Row
+        # WAL lets readers carry on while another worker is writing
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+    def begin(self, source_path):
+        """
+        Input: Path to a bundle on disk.
+
+        Output: The bundle's record as a dict, creating a 'pending' one with a new dataset ID
+               if this exact bundle (path, size, mtime) hasn't been seen before.
+        """
+        key = bundle_key(source_path)
+        record = self.get(key)
+        if record:
+            return record
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO bundles (source_path, size, mtime, dataset_id, stage, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                key + (str(uuid.uuid4()), 'pending', _now()))
+        return self.get(key)
+
+    def get(self, key):
+        row = self.conn.execute(
+            "SELECT * FROM bundles WHERE source_path = ? AND size = ? AND mtime = ?", key).fetchone()
+        return dict(row) if row else None
+
+    def advance(self, record, stage, **fields):
+        """
+        Record that 'stage' has completed for this bundle.  Extra keyword arguments
+        (h5ad_path, json_path, is_en, md5, dataset_id) are stored alongside.  The record dict passed
+        in is updated to match.
+        """
+        if stage not in STAGES:
+            raise Exception("Unknown ingest stage: {0}".format(stage))
+        fields['stage'] = stage
+        fields['error'] = None
+        self._update(record, fields)
+
+    def set_md5(self, record, md5):
+        self._update(record, {'md5': md5})
+
+    def find_content(self, record):
+        """
+        Input: A bundle record with its md5 set.
+
+        Output: The record of another bundle with the same MD5 that got at least as far as
+               'mapped' (preferring one that was uploaded), or None.
+        """
+        if not record.get('md5'):
+            return None
+        rows = self.conn.execute(
+            "SELECT * FROM bundles WHERE md5 = ? AND stage IN ('mapped', 'uploaded') "
+            "ORDER BY stage = 'uploaded' DESC, updated DESC", (record['md5'],))
+        for row in rows:
+            if (row['source_path'], row['size'], row['mtime']) != (record['source_path'], record['size'], record['mtime']):
+                return dict(row)
+        return None
+
+    def claim_content(self, record, run_id):
+        """
+        Input: A bundle record with its md5 set, and the ID of the crawler run it is part of.
+
+        Output: The record of another bundle with the same content whose work can be reused
+               (uploaded, or mapped with its H5AD and JSON still on disk), or failing that
+               the record of another bundle this run is converting the same content for.
+               None if neither exists, in which case this bundle now holds the claim on the
+               MD5 until release_content().
+
+        The lookup and the claim happen in one write transaction, so of several bundles
+        with the same bytes exactly one ends up converting them.  Claims left by an earlier
+        run (one that was killed mid-conversion) are taken over.
+        """
+        if not record.get('md5'):
+            return None
+        key = (record['source_path'], record['size'], record['mtime'])
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            found = self.find_content(record)
+            if not (found and (found['stage'] == 'uploaded' or _on_disk(found))):
+                found = self.conn.execute(
+                    "SELECT bundles.* FROM content_claims JOIN bundles USING (source_path, size, mtime) "
+                    "WHERE content_claims.md5 = ? AND content_claims.run_id = ?", (record['md5'], run_id)).fetchone()
+                found = dict(found) if found else None
+            if found and (found['source_path'], found['size'], found['mtime']) == key:
+                found = None
+            if not found:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO content_claims (md5, source_path, size, mtime, run_id, updated) "
+                    "VALUES (?, ?, ?, ?, ?, ?)", (record['md5'],) + key + (run_id, _now()))
+        except:
+            self.conn.rollback()
+            raise
+        self.conn.commit()
+        return found
+
+    def release_content(self, record):
+        """Drop this bundle's claim on its MD5, if it holds one."""
+        if not record.get('md5'):
+            return
+        with self.conn:
+            self.conn.execute(
+                "DELETE FROM content_claims WHERE md5 = ? AND source_path = ? AND size = ? AND mtime = ?",
+                (record['md5'], record['source_path'], record['size'], record['mtime']))
+
+    def fail(self, record, error):
+        """Note why a bundle failed without moving it back from the last completed stage."""
+        self._update(record, {'error': str(error)})
+
+    def get_mark(self, source):
+        """The high-water mark last recorded for a discovery source, or None."""
+        row = self.conn.execute("SELECT mark FROM discovery_marks WHERE source = ?", (source,)).fetchone()
+        return row['mark'] if row else None
+
+    def set_mark(self, source, mark):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO discovery_marks (source, mark, updated) VALUES (?, ?, ?)",
+                (source, mark, _now()))
+
+    def manifest_snapshot(self):
+        """The stored manifest snapshot as a {path: (size, mtime)} dict."""
+        return {row['path']: (row['size'], row['mtime'])
+                for row in self.conn.execute("SELECT path, size, mtime FROM manifest_snapshot")}
+
+    def update_manifest_snapshot(self, changed, removed):
+        """
+        Input: (path, size, mtime) tuples for bundles added or changed since the stored
+               snapshot, and the paths of bundles no longer in the manifest.
+        """
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO manifest_snapshot (path, size, mtime) VALUES (?, ?, ?)", changed)
+            self.conn.executemany("DELETE FROM manifest_snapshot WHERE path = ?", [(path,) for path in removed])
+
+    def _update(self, record, fields):
+        fields['updated'] = _now()
+        columns = sorted(fields)
+        assignments = ", ".join("{0} = ?".format(c) for c in columns)
+        with self.conn:
+            self.conn.execute(
+                "UPDATE bundles SET {0} WHERE source_path = ? AND size = ? AND mtime = ?".format(assignments),
+                [fields[c] for c in columns] + [record['source_path'], record['size'], record['mtime']])
+        record.update(fields)
+
+def bundle_key(source_path):
+    """(absolute path, size, integer mtime) identifying one version of a bundle on disk."""
+    st = os.stat(source_path)
+    return (os.path.abspath(source_path), st.st_size, int(st.st_mtime))
+
+def file_md5(path):
+    """MD5 hex digest of a file, read in HASH_CHUNK pieces."""
+    md5 = hashlib.md5()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def reached(record, stage):
+    """True if the record has completed 'stage' (or any later one)."""
+    return STAGES.index(record['stage']) >= STAGES.index(stage)
+
+def _on_disk(record):
+    """True if the record's H5AD and JSON are both still where it left them."""
+    return os.path.isfile(record['h5ad_path'] or '') and os.path.isfile(record['json_path'] or '')
+
+def _now():
+    return datetime.datetime.now().isoformat(timespec='seconds')
+
+
+class ProcessedIndex:
+    """
+    Exact-match set of the bundle paths recorded in the crawler's tracking log.
+
+    The tracking log written by setup_logger() is tab-delimited:
+
+        <asctime>\t<bundle path>\t<dataset_id>\t<status>
+
+    Older logs instead carry a header row naming a 'Processed_Files' column, which is used
+    when present.  Rows with a FAILED status aren't counted as processed.
+
+    The log is read once, up front, so checking a candidate bundle is a single set lookup.
+    """
+    def __init__(self, log_path):
+        self.log_path = log_path
+        self.paths = set()
+        self.path_column = 1
+        self._read()
+
+    def __contains__(self, path):
+        return path in self.paths
+
+    def __len__(self):
+        return len(self.paths)
+
+    def _read(self):
+        if not os.path.isfile(self.log_path):
+            return
+        with open(self.log_path) as fh:
+            for line in fh:
+                self._add_line(line.rstrip("\n"))
+
+    def _add_line(self, line):
+        fields = line.split("\t")
+        if 'Processed_Files' in fields:
+            self.path_column = fields.index('Processed_Files')
+            return
+        if len(fields) <= self.path_column:
+            return
+        if fields[-1] == "FAILED":
+            return
+        self.paths.add(fields[self.path_column])
@@ -13,6 +13,16 @@ export PYTHONPATH=$HOME/git/gEAR/lib:$PYTHONPATH
 export GOOGLE_APPLICATION_CREDENTIALS=/usr/local/projects/nemo/nemo-analytics-service-key.json
 ./nemo_gcloud_processor.py
 
+Datasets are found by listing the bucket a page at a time, or, with --manifest, from the
+manifests nemo_upload_crawler.py --bucket_manifest writes under manifests/:
+
+./nemo_gcloud_processor.py --manifest manifests/
+
+Per-stage timings go to a JSON-lines file with --metrics_file, and a summary of them is
+logged at the end of every run:
+
+./nemo_gcloud_processor.py --metrics_file /tmp/processor.metrics.jsonl
+
 Depends on a .conf.ini file in the same directory as this script with the following entries:
 
 [paths]
@@ -30,9 +40,12 @@ Other entries can be there, but these are all that this script requires.
 """
 
 import argparse, json, os, sys
+import collections
 import datetime
+import queue
 import shutil
 import subprocess
+import threading
 import uuid
 
 import configparser
@@ -47,19 +60,41 @@ sys.path.append(os.path.join(config.get("paths", "gear_dir"), "lib"))
 from gear.metadata import Metadata
 
 from google.cloud import storage
+import gcs_batch
+import ingest_metrics
 GCLOUD_PROJECT = config.get("gcloud", "project")
 GCLOUD_BUCKET = config.get("gcloud", "bucket")
+# Where nemo_upload_crawler.py writes the manifests of what it uploaded
+MANIFEST_PREFIX = "manifests/"
 
 PROCESSING_DIRECTORY = config.get("paths", "processing_dir")
 DESTINATION_PATH = config.get("paths", "dataset_dest")
 DATASET_OWNER_ID = config.get("metadata", "dataset_owner_id")
 DEFAULT_ANNOT_RELEASE_NUM = config.get("metadata", "annot_release_num")
 LOG_FH = open(config.get("paths", "dataset_processing_log"), 'a')
+# Pipeline stages log from several threads
+LOG_LOCK = threading.Lock()
+
+# Tells a pipeline stage's threads there is nothing more coming
+_STOP = object()
+
+# A dataset in the bucket: its ID and the blobs of its two files
+BucketDataset = collections.namedtuple('BucketDataset', ['dataset_id', 'h5ad', 'json'])
 
 
 def main():
     parser = argparse.ArgumentParser( description='NeMO data processor for gEAR')
     parser.add_argument('-s', '--skip_ids', type=str, required=False, help='Comma-separated list of IDs to skip while processing' )
+    parser.add_argument('--download_workers', type=int, default=4, help='Number of datasets downloaded from the bucket concurrently (default: 4)')
+    parser.add_argument('--db_workers', type=int, default=2, help='Number of datasets whose metadata is parsed and saved to MySQL concurrently (default: 2)')
+    parser.add_argument('--publish_workers', type=int, default=2, help='Number of datasets moved into place and removed from the bucket concurrently (default: 2)')
+    parser.add_argument('--queue_size', type=int, default=4, help='How many datasets may wait between stages.  Bounds the downloaded-but-unprocessed files in processing_dir (default: 4)')
+    parser.add_argument('--publish_window', type=int, default=50, help='Published datasets whose bucket files are deleted together, in batch requests of up to {0} objects (default: 50)'.format(gcs_batch.MAX_BATCH))
+    parser.add_argument('-p', '--prefix', type=str, help='Only list bucket objects whose names start with this prefix')
+    parser.add_argument('-m', '--manifest', type=str, help='Read the datasets to process from crawler-written manifest objects with this name or prefix (e.g. {0}) instead of listing the bucket'.format(MANIFEST_PREFIX))
+    parser.add_argument('--metrics_file', help='Append per-stage timing and resource use of every dataset to this JSON-lines file')
+    parser.add_argument('--profile_dir', help='Write a cProfile of each dataset stage here, keeping those of the --profile_top slowest datasets')
+    parser.add_argument('--profile_top', type=int, default=5, help='Number of the slowest datasets whose profiles are kept (default: 5)')
     args = parser.parse_args()
 
     ids_to_skip = []
@@ -70,91 +105,260 @@ def main():
     sclient = storage.Client(project=GCLOUD_PROJECT)
     bucket = storage.bucket.Bucket(client=sclient, name=GCLOUD_BUCKET)
 
-    h5s = get_bucket_h5_list(sclient, bucket)
-    log('INFO', "There are {0} H5AD files to process".format(len(h5s)))
-
-    for h5 in h5s:
-        dataset_id = h5.replace('.h5ad', '')
-
-        if dataset_id in ids_to_skip:
-            log('INFO', "Skipping dataset_id:{0} because it is in the skip list".format(dataset_id))
-            continue
-
-        h5_blob = bucket.blob("{0}.h5ad".format(dataset_id))
-
-        log('INFO', "Started processing dataset_id:{0}".format(dataset_id))
-        download_data_for_processing(bucket, dataset_id)
-
-        metadata_path = "{0}/{1}.json".format(PROCESSING_DIRECTORY, dataset_id)
-        h5ad_path = "{0}/{1}.h5ad".format(PROCESSING_DIRECTORY, dataset_id)
-
-        log('INFO', "Parsing metadata for dataset_id:{0}".format(dataset_id))
-        metadata = Metadata(file_path=metadata_path)
-        metadata.add_field_value('dataset_uid', dataset_id)
-        metadata.add_field_value('owner_id', DATASET_OWNER_ID)
-        metadata.add_field_value('schematic_image', '')
-        metadata.add_field_value('share_uid', str(uuid.uuid4()))
-        metadata.add_field_value('default_plot_type', '')
-        metadata.add_field_value('is_public', '1')
-
-        # Populates empty fields from GEO (if GEO GSE ID was given)
-        if metadata.get_field_value('geo_accession'):
-            #log('DEBUG', "Got this value for geo_accession: {0}".format(metadata.get_field_value('geo_accession')))
-            #log('DEBUG', "geo_accession is a {0}".format(type(metadata.get_field_value('geo_accession'))))
-            try:
-                metadata.populate_from_geo()
-            except KeyError:
-                log('WARN', 'Unable to process GEO ID.  Please check it and try again.')
-
-        # hack for annotation source currently until NCBI is supported
-        annot_release = metadata.get_field_value('annotation_release_number')
-        if isinstance(annot_release, dict):
-            if annot_release['value'].startswith('hg'):
-                annot_release['value'] = DEFAULT_ANNOT_RELEASE_NUM
-        else:
-            if annot_release.startswith('hg'):
-                annot_release = DEFAULT_ANNOT_RELEASE_NUM
-
+    manifests = list()
+    # Manifest datasets a previous run already published
+    gone = set()
+    if args.manifest:
+        manifests = [(blob, read_manifest(blob)) for blob in sclient.list_blobs(bucket, prefix=args.manifest)
+                     if blob.name.endswith('.jsonl')]
+        log('INFO', "Reading datasets from {0} manifest objects".format(len(manifests)))
+        datasets = iter_manifest_datasets(sclient, bucket, [entries for _, entries in manifests], gone=gone)
+    else:
+        datasets = iter_bucket_datasets(sclient, bucket, prefix=args.prefix)
+
+    def wanted(datasets):
+        for dataset in datasets:
+            if dataset.dataset_id in ids_to_skip:
+                log('INFO', "Skipping dataset_id:{0} because it is in the skip list".format(dataset.dataset_id))
+                continue
+            yield dataset
+
+    # Each dataset goes download -> metadata/DB -> publish.  The stages run side by side,
+    # so one dataset's download overlaps with another's database work, and the first
+    # datasets start downloading while the rest of the listing is still being read.
+    # Bucket files of published datasets are deleted a window at a time in batch requests
+    deleter = gcs_batch.BatchDeleter(sclient, window=2 * args.publish_window)
+    metrics = ingest_metrics.Metrics(args.metrics_file, args.profile_dir, args.profile_top)
+
+    def timed(name, fn):
+        def run(item):
+            dataset_id = getattr(item, 'dataset_id', item)
+            with metrics.stage(dataset_id, name), \
+                 ingest_metrics.profiled(args.profile_dir, "{0}.{1}".format(dataset_id, name)):
+                return fn(item)
+        return run
+
+    try:
+        published = set(run_pipeline(wanted(datasets), [
+            ('download', timed('download', download_stage), args.download_workers),
+            ('metadata', timed('metadata', metadata_stage), args.db_workers),
+            ('publish', timed('publish', lambda dataset_id: publish_stage(bucket, deleter, dataset_id)), args.publish_workers),
+        ], args.queue_size))
+    finally:
+        deleter.flush()
+    log('INFO', "Published {0} datasets".format(len(published)))
+
+    for line in metrics.summary():
+        log('INFO', "Stage {0}".format(line))
+    if args.profile_dir:
+        log('INFO', "Kept profiles of the slowest datasets in {0}: {1}".format(args.profile_dir, ", ".join(metrics.prune_profiles())))
+    metrics.close()
+
+    # A manifest is done with once everything it lists has been published, now or by an
+    # earlier run, or is being skipped
+    settled = published | gone | set(ids_to_skip)
+    finished = [manifest for manifest, entries in manifests
+                if all(entry['dataset_id'] in settled for entry in entries)]
+    gcs_batch.delete_blobs(sclient, finished)
+    for manifest in finished:
+        log('INFO', "Removed finished manifest {0}".format(manifest.name))
+
+
+def download_stage(dataset):
+    log('INFO', "Started processing dataset_id:{0}".format(dataset.dataset_id))
+    download_data_for_processing(dataset)
+    return dataset.dataset_id
+
+def metadata_stage(dataset_id):
+    """Parse the dataset's metadata and save it to the database.  Returns None if the save failed."""
+    metadata_path = "{0}/{1}.json".format(PROCESSING_DIRECTORY, dataset_id)
+
+    log('INFO', "Parsing metadata for dataset_id:{0}".format(dataset_id))
+    metadata = Metadata(file_path=metadata_path)
+    metadata.add_field_value('dataset_uid', dataset_id)
+    metadata.add_field_value('owner_id', DATASET_OWNER_ID)
+    metadata.add_field_value('schematic_image', '')
+    metadata.add_field_value('share_uid', str(uuid.uuid4()))
+    metadata.add_field_value('default_plot_type', '')
+    metadata.add_field_value('is_public', '1')
+
+    # Populates empty fields from GEO (if GEO GSE ID was given)
+    if metadata.get_field_value('geo_accession'):
+        #log('DEBUG', "Got this value for geo_accession: {0}".format(metadata.get_field_value('geo_accession')))
+        #log('DEBUG', "geo_accession is a {0}".format(type(metadata.get_field_value('geo_accession'))))
         try:
-            metadata.save_to_mysql(status='completed')
-            log('INFO', "Saved metadata to database for dataset_id:{0}".format(dataset_id))
-        except Exception as err:
-            log('ERROR', "Failed to save metadata to database for dataset_id:{0} because: {1}".format(dataset_id, err))
-            continue
-
-        # place the files where they go on the file system to be live in gEAR
+            metadata.populate_from_geo()
+        except KeyError:
+            log('WARN', 'Unable to process GEO ID.  Please check it and try again.')
+
+    # hack for annotation source currently until NCBI is supported
+    annot_release = metadata.get_field_value('annotation_release_number')
+    if isinstance(annot_release, dict):
+        if annot_release['value'].startswith('hg'):
+            annot_release['value'] = DEFAULT_ANNOT_RELEASE_NUM
+    else:
+        if annot_release.startswith('hg'):
+            annot_release = DEFAULT_ANNOT_RELEASE_NUM
+
+    try:
+        metadata.save_to_mysql(status='completed')
+        log('INFO', "Saved metadata to database for dataset_id:{0}".format(dataset_id))
+    except Exception as err:
+        log('ERROR', "Failed to save metadata to database for dataset_id:{0} because: {1}".format(dataset_id, err))
+        return None
+    return dataset_id
+
+def publish_stage(bucket, deleter, dataset_id):
+    """
+    Move the files into place in gEAR, then queue them for removal from the bucket with
+    the gcs_batch.BatchDeleter.  Returns None on failure.
+    """
+    metadata_path = "{0}/{1}.json".format(PROCESSING_DIRECTORY, dataset_id)
+    h5ad_path = "{0}/{1}.h5ad".format(PROCESSING_DIRECTORY, dataset_id)
+
+    # place the files where they go on the file system to be live in gEAR
+    try:
+        shutil.move(metadata_path, "{0}/".format(DESTINATION_PATH))
+        shutil.move(h5ad_path, "{0}/".format(DESTINATION_PATH))
+        log('INFO', "Successfully migrated datafiles for dataset_id:{0}".format(dataset_id))
+    except:
+        log('ERROR', "Failed to migrate datafiles for dataset_id:{0}".format(dataset_id))
+        return None
+
+    # remove files from bucket
+    for extension in ['h5ad', 'json']:
+        deleter.delete(bucket.blob("{0}.{1}".format(dataset_id, extension)))
+    return dataset_id
+
+def run_pipeline(items, stages, queue_size):
+    """
+    Input: The items to process and a list of (name, function, worker count) stages.
+
+    Each stage has its own pool of threads reading from a bounded queue.  A stage function
+    takes an item and returns what to hand to the next stage, or None to drop the item.
+    An exception in a stage is logged and drops only that item.  Returns the last stage's
+    results once every item has left it.
+    """
+    queues = [queue.Queue(maxsize=queue_size) for _ in stages]
+    # Whatever the last stage returns.  Unbounded, since nothing downstream drains it.
+    done = queue.Queue()
+    pools = list()
+
+    for i, (name, fn, workers) in enumerate(stages):
+        inbox = queues[i]
+        outbox = queues[i + 1] if i + 1 < len(queues) else done
+        threads = [threading.Thread(target=_stage_worker, args=(name, fn, inbox, outbox),
+                                    name="{0}-{1}".format(name, n), daemon=True)
+                   for n in range(max(1, workers))]
+        for thread in threads:
+            thread.start()
+        pools.append(threads)
+
+    # put() blocks while the first stage is saturated, which is the backpressure.  items
+    # may be a generator, in which case work starts on the first item it yields.
+    for item in items:
+        queues[0].put(item)
+
+    # Shut the stages down in order so each drains whatever the previous one handed it
+    for inbox, threads in zip(queues, pools):
+        inbox.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+    finished = list()
+    while not done.empty():
+        finished.append(done.get())
+    return finished
+
+def _stage_worker(name, fn, inbox, outbox):
+    while True:
+        item = inbox.get()
+        if item is _STOP:
+            # Pass the marker on to the next sibling thread in this stage
+            inbox.put(_STOP)
+            return
         try:
-            shutil.move(metadata_path, "{0}/".format(DESTINATION_PATH))
-            shutil.move(h5ad_path, "{0}/".format(DESTINATION_PATH))
-            log('INFO', "Successfully migrated datafiles for dataset_id:{0}".format(dataset_id))
-        except:
-            log('ERROR', "Failed to migrate datafiles for dataset_id:{0}".format(dataset_id))
+            result = fn(item)
+        except Exception as err:
+            log('ERROR', "Stage {0} failed for {1}: {2}".format(name, item, err))
             continue
-
-        # remove files from bucket
-        for extension in ['h5ad', 'json']:
-            blob = bucket.blob("{0}.{1}".format(dataset_id, extension))
-            blob.delete()
+        if result is not None:
+            outbox.put(result)
 
 
-def download_data_for_processing(bucket, dataset_id):
-    for extension in ['h5ad', 'json']:
-        path = "{0}/{1}.{2}".format(PROCESSING_DIRECTORY, dataset_id, extension)
-        blob = bucket.blob("{0}.{1}".format(dataset_id, extension))
-        log('INFO', "Downloading file: {0}".format("{0}.{1}".format(dataset_id, extension)))
+def download_data_for_processing(dataset):
+    # The blobs came from the listing (or manifest), so there's no lookup before the download
+    for extension, blob in [('h5ad', dataset.h5ad), ('json', dataset.json)]:
+        path = "{0}/{1}.{2}".format(PROCESSING_DIRECTORY, dataset.dataset_id, extension)
+        log('INFO', "Downloading file: {0}".format(blob.name))
         blob.download_to_filename(path)
 
-def get_bucket_h5_list(sclient, bucket):
-    h5s = list()
-
-    for blob in sclient.list_blobs(bucket):
-        if blob.name.endswith('.h5ad'):
-            h5s.append(blob.name)
-
-    return h5s
+def iter_bucket_datasets(sclient, bucket, prefix=None):
+    """
+    Input: A storage client, the bucket and an optional object name prefix.
+
+    Output: Yields a BucketDataset for each dataset with both its .h5ad and .json in the
+           bucket.  The listing is read a page at a time, and a dataset is yielded as soon
+           as the page holding the second of its files arrives.
+    """
+    partial = dict()
+    for page in sclient.list_blobs(bucket, prefix=prefix).pages:
+        for blob in page:
+            if blob.name.endswith('.h5ad'):
+                dataset_id, extension = blob.name[:-len('.h5ad')], 'h5ad'
+            elif blob.name.endswith('.json'):
+                dataset_id, extension = blob.name[:-len('.json')], 'json'
+            else:
+                continue
+            files = partial.setdefault(dataset_id, dict())
+            files[extension] = blob
+            if len(files) == 2:
+                del partial[dataset_id]
+                yield BucketDataset(dataset_id, files['h5ad'], files['json'])
+
+    for dataset_id, files in partial.items():
+        if 'h5ad' in files:
+            log('WARN', "Skipping dataset_id:{0} because it has no JSON in the bucket".format(dataset_id))
+
+def iter_manifest_datasets(sclient, bucket, manifests, window=gcs_batch.MAX_BATCH // 2, gone=None):
+    """
+    Input: A storage client, the bucket, the entries of each manifest (see
+           read_manifest()) and optionally a set to add the IDs of datasets with neither
+           file left in the bucket to (published by an earlier run).
+
+    Output: Yields a BucketDataset for each dataset the manifests list whose files are
+           still in the bucket, without listing the bucket.  The files' metadata is
+           fetched for window datasets at a time in one batch request.
+    """
+    seen = set()
+    datasets = list()
+    for entries in manifests:
+        for entry in entries:
+            if entry['dataset_id'] in seen:
+                continue
+            seen.add(entry['dataset_id'])
+            datasets.append(BucketDataset(entry['dataset_id'], bucket.blob(entry['h5ad']), bucket.blob(entry['json'])))
+
+    for start in range(0, len(datasets), window):
+        batch = datasets[start:start + window]
+        found = set(blob.name for blob in gcs_batch.reload_blobs(sclient, [b for d in batch for b in (d.h5ad, d.json)]))
+        for dataset in batch:
+            if dataset.h5ad.name in found and dataset.json.name in found:
+                yield dataset
+            elif dataset.h5ad.name not in found and dataset.json.name not in found:
+                log('INFO', "Skipping dataset_id:{0} because its files are already gone from the bucket".format(dataset.dataset_id))
+                if gone is not None:
+                    gone.add(dataset.dataset_id)
+            else:
+                log('WARN', "Skipping dataset_id:{0} because its files are no longer in the bucket".format(dataset.dataset_id))
+
+def read_manifest(manifest):
+    """The entries of a crawler manifest: one JSON object per line with dataset_id, h5ad and json."""
+    return [json.loads(line) for line in manifest.download_as_bytes().decode().splitlines() if line.strip()]
 
 def log(level, msg):
-    print("{0} - {1}: {2}".format(level, datetime.datetime.now(), msg), flush=True, file=LOG_FH)
+    with LOG_LOCK:
+        print("{0} - {1}: {2}".format(level, datetime.datetime.now(), msg), flush=True, file=LOG_FH)
 
 def run_command(cmd):
     log("INFO", "Running command: {0}".format(cmd))
@@ -24,10 +24,11 @@ export PATH=/usr/local/common/Python-3.7.2/bin:$PATH
 """
 
 import argparse, json, os, sys
+import concurrent.futures
 import datetime
-import uuid
+import anndata
 import pandas
-import tarfile, gzip
+import tarfile
 import csv
 import itertools
 import subprocess
@@ -50,33 +51,76 @@ import mysql_tables as tables
 from google.cloud import storage
 GCLOUD_PROJECT = config.get("gcloud", "project")
 GCLOUD_BUCKET = config.get("gcloud", "bucket")
+# Manifests of uploaded datasets for nemo_gcloud_processor.py --manifest
+MANIFEST_PREFIX = "manifests/"
 
 #Path to single log file with processed datasets
 PROCESSED_LOGFILE = config.get("paths", "cron_upload_log")
 
+# Best-Ensembl-release cache, shared by every crawler run
+ENSEMBL_CACHE_DIR = config.get("paths", "ensembl_cache_dir", fallback=os.path.join(os.path.dirname(os.path.abspath(PROCESSED_LOGFILE)), "ensembl_cache"))
+
+# Bundle types picked out of the identifiers database's derived table
+DB_EXTENSIONS = ['.mex.tar.gz', '.tab.analysis.tar', '.tab.counts.tar']
+# Identifiers per IN (...) lookup
+IDENTIFIER_BATCH = 1000
+# Rows pulled per round trip from a server-side cursor
+FETCH_SIZE = 10000
+# discovery_marks entry for -db --incremental
+DERIVED_MARK = "derived"
+
+# Storage clients can't be shared across worker processes, so each process builds its own
+_bucket = None
+
 # Read gEAR library modules
 #sys.path.append(os.path.join(config.get("paths", "gear_dir"), "lib"))
 from gear.metadata import Metadata
-from gear.dataarchive import DataArchive
+
+# Bundle readers shared with the upload scripts
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "scripts"))
+import archiveinspector
+import parallelgzip
+import tarstreamer
+
+import ensembl_mapper
+import gcs_transfer
+import ingest_metrics
+import ingest_state
 
 def main():
     parser = argparse.ArgumentParser( description='NeMO data processor for gEAR')
 
     inputtype = parser.add_mutually_exclusive_group(required=True)
-    #inputtype.add_argument('-ilb', '--input_log_base', type=str, help='Path to the base directory where the logs are found' )
+    inputtype.add_argument('-ilb', '--input_log_base', type=str, help='Path to the base directory where the bundle logs are found' )
     inputtype.add_argument('-id', '--input_directory', type=str, help='Path to a single input directory with tar files' )
     inputtype.add_argument('-l', '--list_file', help='Path to a file containing a list of bundled tar files.')
     inputtype.add_argument('-I', '--identifiers_list', help='File containing a list of NeMO identifiers for files to upload.')
     inputtype.add_argument('-m', '--manifest_file', help='Path to a file manifest containing `ls -l` contents')
+    parser.add_argument('--manifest_diff', help="With -m, only process bundles added or changed since the manifest last read with this option", action='store_true')
     inputtype.add_argument('-db', '--database', help="Get all qualifying files out of database.  Credentials provide by config file", action='store_true')
     parser.add_argument('-ob', '--output_base', type=str, required=True, help='Path to a local output directory where files can be written while processing' )
     parser.add_argument('-s', '--metadata_xls', help='Path to a Excel-formatted spreadsheet of metadata')
+    parser.add_argument('-w', '--workers', type=int, default=1, help='Number of datasets to process concurrently in separate worker processes')
+    parser.add_argument('-uw', '--upload_workers', type=int, default=4, help='Number of datasets uploaded to the bucket concurrently (default: 4)')
+    parser.add_argument('--bucket_manifest', help="Write a manifest of the uploaded datasets to the bucket for nemo_gcloud_processor.py --manifest", action='store_true')
+    parser.add_argument('--state_db', help='SQLite file recording per-bundle progress across runs.  Defaults to the ingest_state_db config entry, then <output_base>/ingest_state.sqlite')
+    parser.add_argument('--incremental', help="With -db, only fetch derived records added since the last incremental run", action='store_true')
+    parser.add_argument('--create_tables', help="With -db or -I, create the identifiers database tables if they don't exist", action='store_true')
+    parser.add_argument('--metrics_file', help='Append per-stage timing and resource use of every dataset to this JSON-lines file')
+    parser.add_argument('--profile_dir', help='Write a cProfile of each dataset here, keeping those of the --profile_top slowest')
+    parser.add_argument('--profile_top', type=int, default=5, help='Number of the slowest datasets whose profiles are kept (default: 5)')
     parser.add_argument('--dry_run', help="Run only up to the point of determining which files will be extracted", action="store_true")
     args = parser.parse_args()
 
-    # TODO: Research OAuth2 service accounts and see if that is a better method than exporting credentials on command line
-    sclient = storage.Client(project=GCLOUD_PROJECT)
-    bucket = storage.bucket.Bucket(client=sclient, name=GCLOUD_BUCKET)
+    state_db = args.state_db or config.get("paths", "ingest_state_db", fallback=os.path.join(args.output_base, "ingest_state.sqlite"))
+    # Create the schema once up front rather than racing to do it in every worker
+    state = ingest_state.IngestState(state_db)
+    # Derived-table key of each bundle found by -db, and the mark they were found after
+    db_keys = None
+    db_after = None
+    manifest_changes = None
+    # MD5s the bundle logs already give for their bundles
+    md5s = dict()
 
     if args.input_directory:
         log("INFO", "Reading from input directory")
@@ -85,83 +129,354 @@ def main():
         log("INFO", "Reading from a list file")
         with open(args.list_file) as f:
             files_pending = [line.rstrip() for line in f]
+    elif args.input_log_base:
+        log("INFO", "Reading from bundle log files")
+        processed = ingest_state.ProcessedIndex(PROCESSED_LOGFILE)
+        log("INFO", "{0} bundles have already been processed".format(len(processed)))
+        files_pending = get_datasets_to_process(args.input_log_base, processed, md5s)
     elif args.manifest_file:
         log("INFO", "Reading from inventory manifest file")
         with open(args.manifest_file) as f:
-            all_lines = [line.rstrip() for line in f]
-            files_pending = get_tar_paths_from_manifest(all_lines)
+            if args.manifest_diff:
+                manifest_changes = diff_manifest(f, state.manifest_snapshot())
+                files_pending = [path for path, size, mtime in manifest_changes[0]]
+                log("INFO", "{0} bundles added or changed and {1} removed since the last manifest".format(
+                    len(files_pending), len(manifest_changes[1])))
+            else:
+                files_pending = get_tar_paths_from_manifest(f)
     else:
-        conn = setup_mysql(config.get("mysql", "ip"), config.get("mysql", "db"), config.get("mysql", "user"), config.get("mysql", "pass"))
+        conn = setup_mysql(get_database_url(), args.create_tables)
         if args.identifiers_list:
             log("INFO", "Reading files based on NeMO identifiers")
             files_pending = get_files_based_on_identifiers(conn, args.identifiers_list)
         else:
-            log("INFO", "Reading all qualifying files from database")
-            files_pending = get_tar_paths_from_database(conn)
+            after = db_after = state.get_mark(DERIVED_MARK) if args.incremental else None
+            log("INFO", "Reading qualifying files from database" if after is None else
+                "Reading qualifying files added to the database after key {0}".format(after))
+            files_pending, db_keys = get_tar_paths_from_database(conn, after)
         conn.close()
-        # SAdkins - Phasing out reading from logfile
-        #files_pending = get_datasets_to_process(args.input_log_base, args.output_base, PROCESSED_LOGFILE)
 
-    for file_path in files_pending:
-        log('INFO', "Processing datafile at path:{0}".format(file_path))
-        if not os.path.isfile(file_path):
-            log('WARN', "File {} was not found... skipping!".format(file_path))
-            continue
-        dataset_id = uuid.uuid4()
-        dataset_dir = extract_dataset(file_path, args.output_base)
+    # Only the parent process writes to the tracking log, regardless of how many workers run
+    logger = setup_logger()
+    summary = dict()
+
+    # Conversion happens in the workers (or inline); all uploads go through the parent's
+    # bounded upload pool so converting the next dataset overlaps with uploading this one.
+    uploader = gcs_transfer.Uploader(get_bucket(), workers=args.upload_workers)
+    metrics = ingest_metrics.Metrics(args.metrics_file, args.profile_dir, args.profile_top)
+    uploads = dict()
+    uploaded = list()
+    uploaded_ids = set()
+    # Datasets whose outcome has been recorded this run
+    settled_ids = set()
+    # Bundles whose content matched a dataset still converting or uploading, by that dataset's ID
+    waiting = dict()
+    failed_paths = set()
+    # Tells this run's claims on bundle content apart from any left by an interrupted run
+    run_id = "{0}-{1}".format(os.getpid(), datetime.datetime.now().isoformat())
+
+    def process(file_path):
+        return process_file(file_path, args.output_base, args.metadata_xls, state_db, md5s.get(file_path), args.profile_dir, run_id)
+
+    def record(result):
+        if result['outcome'] == 'failed':
+            failed_paths.add(result['file_path'])
+        record_result(result, logger, summary)
+        settled_ids.add(result['dataset_id'])
+        # Duplicates of it are done if it went up, or convert/upload the files themselves if not
+        for duplicate in waiting.pop(result['dataset_id'], []):
+            route(duplicate)
+
+    def finish(future):
+        # Already finished by a nested dispatch() of a bundle that was waiting on another
+        if future not in uploads:
+            return
+        result = finish_upload(future, uploads.pop(future), state)
+        if result['outcome'] == 'uploaded':
+            uploaded.append(result)
+            uploaded_ids.add(result['dataset_id'])
+        record(result)
+
+    def route(result):
+        dataset_id = result['dataset_id']
+        if result['outcome'] == 'waiting':
+            # Another worker held this content; once it's settled, the bundle is looked up again
+            if dataset_id in settled_ids:
+                dispatch(process(result['file_path']))
+            else:
+                waiting.setdefault(dataset_id, list()).append(result)
+        elif result['outcome'] != 'converted':
+            record(result)
+        elif dataset_id in uploaded_ids:
+            # Same content (and so the same dataset ID and files) as a bundle uploaded this run
+            state.advance(result['record'], 'uploaded')
+            result['outcome'] = 'duplicate'
+            result['status'] = "DUPLICATE"
+            record(result)
+        elif any(r['dataset_id'] == dataset_id for r in uploads.values()):
+            # Uploading the same objects twice at once would trip over each other's parts
+            waiting.setdefault(dataset_id, list()).append(result)
+        else:
+            uploads[upload_to_cloud(uploader, result['status'], result['json_path'], metrics, dataset_id)] = result
+
+    def dispatch(result):
+        metrics.add(result['metrics'])
+        route(result)
+        for future in [f for f in uploads if f.done()]:
+            finish(future)
+
+    if args.workers > 1:
+        log('INFO', "Processing {0} files with {1} workers".format(len(files_pending), args.workers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers) as executor:
+            futures = [executor.submit(process_file, file_path, args.output_base, args.metadata_xls, state_db, md5s.get(file_path), args.profile_dir, run_id)
+                       for file_path in files_pending]
+            for future in concurrent.futures.as_completed(futures):
+                dispatch(future.result())
+    else:
+        for file_path in files_pending:
+            dispatch(process(file_path))
+
+    # finish() may start the upload of a bundle that was waiting on a failed one
+    while uploads:
+        done, _ = concurrent.futures.wait(list(uploads), return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            finish(future)
+    if args.bucket_manifest and uploaded:
+        write_bucket_manifest(uploader, uploaded, args.output_base)
+    uploader.shutdown()
+    # Only move the mark once the run is through, so an interrupted run fetches the same records again
+    if args.incremental and db_keys is not None:
+        db_mark = high_water_mark(db_keys, failed_paths, db_after)
+        if db_mark is not None:
+            state.set_mark(DERIVED_MARK, db_mark)
+            log('INFO', "Recorded database high-water mark {0}".format(db_mark))
+    if manifest_changes is not None:
+        # Failed bundles stay out of the snapshot so the next diff offers them again
+        changed, removed = manifest_changes
+        state.update_manifest_snapshot([c for c in changed if c[0] not in failed_paths], removed)
+    state.close()
+
+    for line in metrics.summary():
+        log('INFO', "Stage {0}".format(line))
+    if args.profile_dir:
+        log('INFO', "Kept profiles of the slowest datasets in {0}: {1}".format(args.profile_dir, ", ".join(metrics.prune_profiles())))
+    metrics.close()
+
+    log('INFO', "Summary: {0}".format(", ".join("{0}={1}".format(k, v) for k, v in sorted(summary.items()))))
+    log('INFO', "Complete! Exiting.")
+    return 1 if summary.get("failed") else 0
 
-        # Load metadata from spreadsheet
-        metadata_file_path = get_metadata_file(dataset_dir, file_path, args.metadata_xls)
-        if not metadata_file_path:
-            log('WARN', "Datatype could not be determined from files in {}... skippping".format(dataset_dir))
-            continue
-        if not os.stat(metadata_file_path).st_size:
-            log('WARN', "Metadata file {} is empty... skipping".format(metadata_file_path))
-            continue
-        log('DEBUG', "Got metadata file: {0}".format(metadata_file_path))
 
-        # Validate metadata against gEAR's validator
-        metadata = Metadata(file_path=metadata_file_path)
-        logger = setup_logger()
-        if metadata.validate():
+def process_file(file_path, output_base, metadata_xls, state_db, md5=None, profile_dir=None, run_id=None):
+    """
+    Input: A path to a dataset tarball, the base output directory, the (optional)
+           metadata spreadsheet used for MEX bundles, the ingest state database, the
+           bundle's MD5 if the bundle log recorded it, a directory to write a cProfile
+           of the dataset's processing to and the ID of the crawler run.
+
+    Output: Runs the extract -> validate -> convert -> map part of the pipeline for one
+           dataset and returns a dict describing the outcome:
+
+           {'file_path': ..., 'dataset_id': ..., 'outcome': 'converted', 'status': h5_path,
+            'json_path': ..., 'record': <ingest state record>, 'metrics': [<stage records>]}
+
+           'outcome' is one of 'converted' (ready for upload_to_cloud), 'done', 'duplicate',
+           'failed', 'invalid', 'skipped' or 'waiting'.  'status' is only set for outcomes that belong
+           in the tracking log.  'metrics' holds an ingest_metrics record per stage run.
+
+    Progress is recorded per stage in the ingest state database.  A bundle that was already
+    uploaded is reported as 'done' without doing any work, and one that stopped partway
+    reuses its dataset ID and any converted/mapped H5AD that is still on disk.
+
+    Bundles are also looked up by MD5 (hashed here unless given, once per bundle version).
+    A bundle with the same bytes as one already uploaded is recorded as a 'duplicate' of
+    that dataset, and one matching a converted but not yet uploaded bundle goes straight
+    to upload with that bundle's H5AD and JSON (main() holds it back while that bundle
+    is still uploading in this run, then records it as a duplicate if the upload worked).
+    The lookup also claims the MD5 for this run (see IngestState.claim_content()), so a
+    bundle whose bytes another worker is converting right now comes back as 'waiting',
+    with that bundle's dataset ID, and main() processes it again once that one is done.
+
+    This is safe to run in a worker process.  Each dataset is extracted into its own
+    scratch directory under output_base which is removed once processing finishes, and
+    nothing is written to the tracking log here.
+    """
+    metrics = ingest_metrics.Recorder()
+    result = {'file_path': file_path, 'dataset_id': None, 'outcome': 'skipped', 'status': None,
+              'json_path': None, 'record': None, 'metrics': metrics.records}
+
+    log('INFO', "Processing datafile at path:{0}".format(file_path))
+    if not os.path.isfile(file_path):
+        log('WARN', "File {} was not found... skipping!".format(file_path))
+        return result
+
+    state = ingest_state.IngestState(state_db)
+    record = state.begin(file_path)
+    dataset_id = record['dataset_id']
+    result['dataset_id'] = dataset_id
+    result['record'] = record
+    if ingest_state.reached(record, 'uploaded'):
+        log('INFO', "Dataset {0} was already uploaded as {1}... skipping".format(file_path, dataset_id))
+        result['outcome'] = 'done'
+        state.close()
+        return result
+
+    scratch_dir = os.path.join(output_base, "scratch", str(dataset_id))
+    with ingest_metrics.profiled(profile_dir, dataset_id):
+        try:
+            if not record['md5'] and md5:
+                state.set_md5(record, md5)
+            elif not record['md5']:
+                with metrics.stage(dataset_id, 'hash'):
+                    state.set_md5(record, ingest_state.file_md5(file_path))
+            original = state.claim_content(record, run_id or str(dataset_id))
+            if original and not ingest_state.reached(original, 'mapped'):
+                log('INFO', "Dataset {0} has the same content as {1}, still being converted... waiting for it".format(
+                    file_path, original['source_path']))
+                result['dataset_id'] = original['dataset_id']
+                result['outcome'] = 'waiting'
+                return result
+            if original and ingest_state.reached(original, 'uploaded'):
+                log('INFO', "Dataset {0} has the same content as {1}, already uploaded as {2}... skipping".format(
+                    file_path, original['source_path'], original['dataset_id']))
+                state.advance(record, 'uploaded', dataset_id=original['dataset_id'], h5ad_path=original['h5ad_path'],
+                              json_path=original['json_path'], is_en=original['is_en'])
+                result['dataset_id'] = original['dataset_id']
+                result['outcome'] = 'duplicate'
+                result['status'] = "DUPLICATE"
+                return result
+            if original:
+                log('INFO', "Dataset {0} has the same content as {1}... reusing H5AD {2}".format(
+                    file_path, original['source_path'], original['h5ad_path']))
+                state.advance(record, 'mapped', dataset_id=original['dataset_id'], h5ad_path=original['h5ad_path'],
+                              json_path=original['json_path'], is_en=original['is_en'])
+                result['dataset_id'] = original['dataset_id']
+                result['status'] = original['h5ad_path']
+                result['json_path'] = original['json_path']
+                result['outcome'] = 'converted'
+                return result
+
+            with metrics.stage(dataset_id, 'extract'):
+                dataset_dir, dtype = extract_dataset(file_path, scratch_dir)
+            if not ingest_state.reached(record, 'extracted'):
+                state.advance(record, 'extracted')
+
+            # Load metadata from spreadsheet
+            with metrics.stage(dataset_id, 'metadata'):
+                metadata_file_path = get_metadata_file(dataset_dir, file_path, metadata_xls, dtype)
+            if not metadata_file_path:
+                log('WARN', "Datatype could not be determined from files in {}... skippping".format(dataset_dir))
+                return result
+            if not os.stat(metadata_file_path).st_size:
+                log('WARN', "Metadata file {} is empty... skipping".format(metadata_file_path))
+                return result
+            log('DEBUG', "Got metadata file: {0}".format(metadata_file_path))
+
+            # Validate metadata against gEAR's validator
+            with metrics.stage(dataset_id, 'validate'):
+                metadata = Metadata(file_path=metadata_file_path)
+                valid = metadata.validate()
+            if not valid:
+                log('ERROR', "Metadata file is NOT valid: {0}".format(metadata_file_path))
+                result['outcome'] = 'invalid'
+                return result
+
             log('INFO', "Metadata file is valid: {0}".format(metadata_file_path))
-            try:
-                metadata_json_path = "{0}/{1}.json".format(args.output_base, dataset_id)
-                metadata.write_json(file_path=metadata_json_path)
-                organism_taxa = get_organism_id(metadata_file_path)
-                # Ensure organism_taxa is string in case Int is passed through JSON
-                organism_id = get_gear_organism_id(str(organism_taxa))
-                if organism_id == -1:
-                    raise
-
-                log('DEBUG', "Organism ID is {}".format(organism_id))
-                # If dataset directory has h5ad file, skip that step
+            metadata_json_path = "{0}/{1}.json".format(output_base, dataset_id)
+            metadata.write_json(file_path=metadata_json_path)
+            organism_taxa = get_organism_id(metadata_file_path)
+            # Ensure organism_taxa is string in case Int is passed through JSON
+            organism_id = get_gear_organism_id(str(organism_taxa))
+            if organism_id == -1:
+                raise Exception("No gEAR organism for taxon {0}".format(organism_taxa))
+
+            log('DEBUG', "Organism ID is {}".format(organism_id))
+            # Pick up an H5AD left by a previous run, as long as it is still on disk
+            h5_path = None
+            is_en = False   # assume ENSEMBL IDs are not present if h5ad was already passed to us
+            if ingest_state.reached(record, 'converted') and record['h5ad_path'] and os.path.isfile(record['h5ad_path']):
+                h5_path = record['h5ad_path']
+                is_en = bool(record['is_en'])
+                log('INFO', "Resuming from previously converted H5AD {0}".format(h5_path))
+            else:
+                # If dataset directory has h5ad file, skip that step.  Move it out of scratch
+                # under the dataset ID, which is the name the processor expects it by.
                 file_list = os.listdir(dataset_dir)
-                h5_path = None
-                is_en = False   # assume ENSEMBL IDs are not present if h5ad was already passed to us
                 for f in file_list:
                     if f.endswith(".h5ad"):
-                        h5_path = "{}/{}".format(dataset_dir, f)
+                        h5_path = os.path.join(output_base, "{0}.h5ad".format(dataset_id))
+                        shutil.move(os.path.join(dataset_dir, f), h5_path)
+                        state.advance(record, 'converted', h5ad_path=h5_path, json_path=metadata_json_path, is_en=int(is_en))
                 if not h5_path:
-                    h5_path, is_en = convert_to_h5ad(dataset_dir, dataset_id, args.output_base)
-
-                ensure_ensembl_index(h5_path, organism_id, is_en)
-                logger.info(file_path, extra={"dataset_id":dataset_id, "status": h5_path})
-                log('INFO', "Uploading {} to GCP bucket".format(h5_path))
-                upload_to_cloud(bucket, h5_path, metadata_json_path)
-            except:
-                log('ERROR', "Failed to process file:{0}. Error is below.".format(file_path))
-                exctype, value = sys.exc_info()[:2]
-                log('ERROR', "{} - {}".format(exctype, value))
-                logger.info(file_path, extra={"dataset_id":dataset_id, "status":"FAILED"})
-        else:
-            log('ERROR', "Metadata file is NOT valid: {0}".format(metadata_file_path))
-    log('INFO', "Complete! Exiting.")
-
+                    # Converted bundles come back already mapped to Ensembl IDs
+                    h5_path = convert_to_h5ad(file_path, dataset_id, output_base, organism_id, metrics)
+                    state.advance(record, 'mapped', h5ad_path=h5_path, json_path=metadata_json_path, is_en=1)
+
+            if not ingest_state.reached(record, 'mapped'):
+                with metrics.stage(dataset_id, 'ensembl'):
+                    ensure_ensembl_index(h5_path, organism_id, is_en)
+                state.advance(record, 'mapped')
+            result['status'] = h5_path
+            result['json_path'] = metadata_json_path
+            result['outcome'] = 'converted'
+        except:
+            log('ERROR', "Failed to process file:{0}. Error is below.".format(file_path))
+            exctype, value = sys.exc_info()[:2]
+            log('ERROR', "{} - {}".format(exctype, value))
+            state.fail(record, "{} - {}".format(exctype, value))
+            result['outcome'] = 'failed'
+            result['status'] = "FAILED"
+        finally:
+            shutil.rmtree(scratch_dir, ignore_errors=True)
+            # Once mapped (or failed) the bundle is found by find_content(), or redone, instead
+            state.release_content(record)
+            state.close()
+    return result
+
+def finish_upload(future, result, state):
+    """Record the outcome of an upload_to_cloud() future against its dataset's result."""
+    try:
+        future.result()
+        state.advance(result['record'], 'uploaded')
+        result['outcome'] = 'uploaded'
+    except Exception as err:
+        log('ERROR', "Failed to upload file:{0}. Error is: {1}".format(result['file_path'], err))
+        state.fail(result['record'], err)
+        result['outcome'] = 'failed'
+        result['status'] = "FAILED"
+    return result
+
+def write_bucket_manifest(uploader, uploaded, output_base):
+    """
+    Input: The uploader, the results of the datasets uploaded this run and the output directory.
 
-def convert_to_h5ad(dataset_dir, dataset_id, output_dir):
+    Output: The manifest's blob name.  Each line of the manifest is a JSON object giving a
+           dataset's ID and the names of its .h5ad and .json objects, which lets the
+           processor find the new datasets without listing the bucket.
+    """
+    name = "crawler-{0}.jsonl".format(datetime.datetime.now().strftime("%Y%m%d-%H%M%S"))
+    path = os.path.join(output_base, name)
+    with open(path, 'w') as fh:
+        for result in uploaded:
+            fh.write(json.dumps({'dataset_id': result['dataset_id'],
+                                 'h5ad': os.path.basename(result['status']),
+                                 'json': os.path.basename(result['json_path'])}) + "\n")
+    blob_name = MANIFEST_PREFIX + name
+    uploader.upload_file(path, blob_name)
+    os.remove(path)
+    log('INFO', "Wrote manifest of {0} uploaded datasets to {1}".format(len(uploaded), blob_name))
+    return blob_name
+
+def record_result(result, logger, summary):
+    """Write a finished dataset to the tracking log and add it to the run summary."""
+    if result['status']:
+        logger.info(result['file_path'], extra={"dataset_id":result['dataset_id'], "status":result['status']})
+    summary[result['outcome']] = summary.get(result['outcome'], 0) + 1
+
+
+def convert_to_h5ad(input_file_path, dataset_id, output_dir, organism_id, metrics=None):
     """
-    Input: An extracted directory containing expression data files to be converted
+    Input: A dataset tarball containing expression data files to be converted
            to H5AD.  These can be MEX or 3tab and should be handled appropriately.
 
     Output: An H5AD file should be created and the path returned.  The name of the
@@ -169,29 +484,31 @@ def convert_to_h5ad(dataset_dir, dataset_id, output_dir):
 
            f50c5432-e9ca-4bdd-9a44-9e1d624c32f5.h5ad
 
+    The expression files are parsed directly from the tar stream (see scripts/tarstreamer.py),
+    so the matrices are never extracted or gunzipped to scratch first.  For uncompressed
+    tars, the member index recorded by extract_dataset() lets the reader seek straight to
+    each matrix file.  The AnnData is
+    mapped to Ensembl IDs in memory (see map_ensembl_index) before it is first written, so
+    the H5AD written here is final.  The read, Ensembl mapping and write are timed as
+    separate stages if an ingest_metrics Recorder is passed.
+
     TBD: Error with writing to file.
     """
+    metrics = metrics or ingest_metrics.Recorder()
     log('DEBUG', "H5AD to be created")
-    is_en = False
-    data_archive = DataArchive()
-    dtype = data_archive.get_archive_type(data_path = dataset_dir)
     filename = str(dataset_id)
     outdir_name = os.path.join(output_dir, filename + ".h5ad")
-    h5AD = None
-    # If errors occur in gEAR's parsing steps propagate upwards
-    try:
-        if dtype == "3tab":
-            h5AD, is_en = data_archive.read_3tab_files(data_path = dataset_dir)
-        elif dtype == "mex":
-            h5AD, is_en = data_archive.read_mex_files(data_path = dataset_dir)
-        else:
-            raise Exception("Undetermined Format: {0}".format(dtype))
-    except:
-        raise
-    if h5AD:
-        h5AD.write_h5ad(output_path = outdir_name, gear_identifier = dataset_id)
-
-    return outdir_name, is_en
+    # If errors occur in parsing steps propagate upwards
+    with metrics.stage(dataset_id, 'read'):
+        h5AD, dtype = tarstreamer.read_bundle(input_file_path, index=archiveinspector.cached(input_file_path))
+    if dtype not in ["3tab", "mex"]:
+        raise Exception("Undetermined Format: {0}".format(dtype))
+    with metrics.stage(dataset_id, 'ensembl'):
+        h5AD = map_ensembl_index(h5AD, organism_id, tarstreamer.has_ensembl_index(h5AD))
+    with metrics.stage(dataset_id, 'write'):
+        h5AD.write_h5ad(outdir_name)
+
+    return outdir_name
 
 def ensure_ensembl_index(h5_path, organism_id, is_en):
     """
@@ -200,16 +517,37 @@ def ensure_ensembl_index(h5_path, organism_id, is_en):
 
     Output: An updated (if necessary) H5AD file indexed on Ensembl IDs after mapping.
            Returns nothing.
+
+    Only needed for H5ADs that arrive pre-built in a bundle.  Converted bundles are mapped
+    in memory by convert_to_h5ad().
     """
+    if is_en:
+        # Nothing to rewrite, but report the release like find_best_ensembl_release_from_h5ad.py did
+        adata = anndata.read_h5ad(h5_path, backed='r')
+        map_ensembl_index(adata, organism_id, is_en)
+        adata.file.close()
+        return
+
+    adata = map_ensembl_index(anndata.read_h5ad(h5_path), organism_id, is_en)
+    adata.write_h5ad("{0}_new.h5ad".format(h5_path))
+    shutil.move("{0}_new.h5ad".format(h5_path), h5_path)
+
+def map_ensembl_index(adata, organism_id, is_en):
+    """
+    Input: An in-memory AnnData, the gEAR organism ID and whether var is already indexed
+           on Ensembl IDs.
 
-    gear_bin_dir = os.path.join(config.get("paths", "gear_dir"), "bin")
-    if is_en == False:
-        add_ensembl_cmd = "python3 {0}/add_ensembl_id_to_h5ad_missing_release.py -i {1} -o {1}_new.h5ad -org {2}".format(gear_bin_dir, h5_path, organism_id)
-        run_command(add_ensembl_cmd)
-        shutil.move("{0}_new.h5ad".format(h5_path), h5_path)
+    Output: The AnnData indexed on Ensembl IDs.  Annotation tables are loaded once per
+           process by ensembl_mapper and reused for every dataset after that, and the
+           chosen release is cached by gene-set fingerprint in ENSEMBL_CACHE_DIR.
+    """
+    mapper = ensembl_mapper.get_mapper(ENSEMBL_CACHE_DIR)
+    if is_en:
+        release = mapper.best_release(organism_id, adata.var.index)
     else:
-        add_ensembl_cmd = "/usr/local/common/Python-3.7.2/bin/python3 {0}/find_best_ensembl_release_from_h5ad.py -i {1} -org {2}".format(gear_bin_dir, h5_path, organism_id)
-        run_command(add_ensembl_cmd)
+        adata, release = mapper.map_to_ensembl(adata, organism_id)
+    log('INFO', "Best Ensembl release for organism {0} is {1}".format(organism_id, release))
+    return adata
 
 
 def extract_dataset(input_file_path, output_base):
@@ -217,56 +555,58 @@ def extract_dataset(input_file_path, output_base):
     Input: A path to an input dataset tarball, and the base directory where output can be
            written temporarily.
 
-    Output: This function will extract the .tar or .tar.gz file and return the path to the
-           directory created.
+    Output: This function will extract the supporting files (metadata, pre-built H5AD) of the
+           .tar or .tar.gz file and return a (directory created, bundle type) tuple.  The bundle
+           type is 'mex', '3tab', 'h5ad' or None.  output_base should be a scratch directory
+           unique to this dataset so concurrent workers never extract over each other.
+
+           MEX and 3tab expression matrices are skipped here.  convert_to_h5ad() streams them
+           straight out of the tarball instead.
 
     Assumptions:  The specification states that the tar or tarball should create a unique
            directory name within which all the files of the dataset are contained.
 
     Example:
            Input:  /path/to/DLPFCcon322polyAgeneLIBD.3tab.tar.gz
-           Output: /path/to/DLPFCcon322polyAgeneLIBD/DLPFCcon322polyAgeneLIBD_COLmeta.tab
-                                                   ./DLPFCcon322polyAgeneLIBD_DataMTX.tab
-                                                   ./DLPFCcon322polyAgeneLIBD_ROWmeta.tab
-                                                   ./DLPFCcon322polyAgeneLIBD_EXPmeta.json
-           Returns: /path/to/DLPFCcon322polyAgeneLIBD
+           Output: /path/to/DLPFCcon322polyAgeneLIBD/DLPFCcon322polyAgeneLIBD_EXPmeta.json
+           Returns: (/path/to/DLPFCcon322polyAgeneLIBD, '3tab')
     """
     log('DEBUG', "Extracting dataset at path: {0}".format(input_file_path))
 
-    tar = tarfile.open(input_file_path)
-    sample_file = tar.next().name   # Get path of first member so we can extract directory later
+    sample_file = None
+    # One forward pass over the archive, inflated off the main thread if it's a .tar.gz
+    with parallelgzip.open_stream(input_file_path) as fh, tarfile.open(fileobj=fh, mode='r|') as tar:
+        for member in tar:
+            if not sample_file:
+                sample_file = member.name   # Get path of first member so we can extract directory later
+            if tarstreamer.member_role(member.name)[1]:
+                continue
+            tar.extract(member, path = output_base)
+        # Keep the member offsets from this walk so convert_to_h5ad() can seek straight to the matrices
+        index = archiveinspector.remember(input_file_path, tar.getmembers())
     if not sample_file:
         raise Exception("Tar file {} appears to be empty".format(input_file_path))
-    #tar.extractall(path = output_base)
-    tar.close()
+    dtype = index.bundle_type
 
     full_sample_file = os.path.join(output_base, sample_file)
     tar_directory = os.path.dirname(full_sample_file)
-    return tar_directory
-
-def get_gear_organism_id(sample_attributes):
-    """
-    data_organism_id = {'id' : [1, 2, 3, 5, 8],
-                        'label' : ['Mouse', 'Human', 'Zebrafish', 'Chicken', 'Macaque'],
-                        'taxon_id' : [10090, 9606, 7955, 9031, 9544]
-                        }
+    os.makedirs(tar_directory, exist_ok=True)
+    return tar_directory, dtype
+
+def get_bucket():
+    """Return the upload bucket, creating one storage client per process on first use."""
+    global _bucket
+    if _bucket is None:
+        # TODO: Research OAuth2 service accounts and see if that is a better method than exporting credentials on command line
+        sclient = storage.Client(project=GCLOUD_PROJECT)
+        _bucket = storage.bucket.Bucket(client=sclient, name=GCLOUD_BUCKET)
+    return _bucket
+
+def get_datasets_to_process(base_dir, processed, md5s=None):
     """
-    if sample_attributes.lower() in ["human", "homo sapiens","9606"]:
-        return 2
-    if sample_attributes.lower() in ["mouse","mus musculus", "10090"]:
-        return 1
-    if sample_attributes.lower() in ["zebrafish", "danio rerio", "7955"]:
-        return 3
-    if sample_attributes.lower() in ["chicken", "gallus gallus", "9031"]:
-        return 5
-    #if sample_attributes.lower() in ["macaque", "macaca mulatta", "9544"]:
-    #    return 8
-    log("ERROR", "Could not associate organism or taxon id {} with a gEAR organism ID".format(sample_attributes))
-    return -1
-
-def get_datasets_to_process(base_dir, output_base, processed_log):
-    """
-    Input: A base directory with log files to process.
+    Input: A base directory with log files to process, an ingest_state.ProcessedIndex
+           of bundles already handled and optionally a dict to fill with each returned
+           bundle's MD5, from logs which have an MD5 column.
 
     Output: A list of dataset archive files to process, like this:
 
@@ -274,29 +614,35 @@ def get_datasets_to_process(base_dir, output_base, processed_log):
         /path/to/otherfilename.tab.counts.tar
 
          Where the contents of these match the specification in docs/input_file_format_standard.md
-    """
 
-    # Open file of previously processed files for reading
-    processed_ds = pandas.read_csv(processed_log, sep='\t', usecols = ['Processed_Files'], header=0)
+    Bundles are matched against the processed index by exact path, so the check is a set
+    lookup per candidate rather than a scan of the whole processed log.
+    """
     formats = [i.upper() for i in ['MEX', 'TABanalysis', 'TABcounts']]
 
     # Gather all of the bundle log output files
     log_file_list = list()
     for entry in os.listdir(base_dir):
         if entry.endswith('diff.log'):
-            log_file_list.append(entry)
+            log_file_list.append(os.path.join(base_dir, entry))
 
-    log_file_list = prepend(log_file_list, base_dir)
     paths_to_return = []
+    seen = set()
     # Open each logfile and get all MEX, TABanalysis, and TABcounts bundle files
     for logfile in log_file_list:
         log('INFO', "Processing log file: {0}".format(logfile))
-        read_log_file = pandas.read_csv(logfile, sep="\t", header=0)
-        hold_relevant_entries = read_log_file.loc[read_log_file['Type'].upper().isin(formats)]
-        for entry in hold_relevant_entries.index:
-            tar_path = os.path.join(hold_relevant_entries['Output Dir'][entry], hold_relevant_entries['Output file'][entry])
-            if not processed_ds['Processed_Files'].str.contains(tar_path).any():
-                paths_to_return.append(tar_path)
+        read_log_file = pandas.read_csv(logfile, sep="\t", header=0, dtype=str)
+        hold_relevant_entries = read_log_file.loc[read_log_file['Type'].str.upper().isin(formats)]
+        md5_columns = [c for c in hold_relevant_entries.columns if 'md5' in c.lower()]
+        bundle_md5s = hold_relevant_entries[md5_columns[0]] if md5_columns else [None] * len(hold_relevant_entries)
+        for out_dir, out_file, md5 in zip(hold_relevant_entries['Output Dir'], hold_relevant_entries['Output file'], bundle_md5s):
+            tar_path = os.path.join(out_dir, out_file)
+            if tar_path in processed or tar_path in seen:
+                continue
+            seen.add(tar_path)
+            paths_to_return.append(tar_path)
+            if md5s is not None and isinstance(md5, str) and len(md5) == 32:
+                md5s[tar_path] = md5.lower()
     return paths_to_return
 
 def get_files_based_on_identifiers(conn, identifiers_list):
@@ -307,34 +653,55 @@ def get_files_based_on_identifiers(conn, identifiers_list):
     release_dir_ptrn = os.path.join(config.get("paths", "release_dir"), "brain")
 
     with open(identifiers_list) as ifh:
-        idents = [line.rstrip() for line in ifh]
+        # Drop blank lines and repeats, keeping the file's order
+        idents = list(dict.fromkeys(line.strip() for line in ifh if line.strip()))
 
     # Right now I believe only derived identifiers are necessary but I would rather include other tables if specified.
     tabletypes = [tables.sequence, tables.alignment, tables.derived]
     desired_files = []
     for t in tabletypes:
-        query = db.select([t.c.file_url]) \
-                .where(t.c.identifier.in_(idents))
-        result_proxy = conn.execute(query)
-        # Iterate through records and add files
-        for row in result_proxy:
-            # Replace HTTP URL with "release/public-facing" pathname
-            desired_files.append(row[0].replace(http_ptrn, release_dir_ptrn))
+        # Bounded IN lists, all over the one connection
+        for start in range(0, len(idents), IDENTIFIER_BATCH):
+            query = db.select([t.c.file_url]) \
+                    .where(t.c.identifier.in_(idents[start:start + IDENTIFIER_BATCH]))
+            for row in stream_rows(conn, query):
+                # Replace HTTP URL with "release/public-facing" pathname
+                desired_files.append(row[0].replace(http_ptrn, release_dir_ptrn))
     return desired_files
 
-def get_metadata_file(base_dir, dmz_path, metadata_sheet):
+def get_gear_organism_id(sample_attributes):
+    """
+    data_organism_id = {'id' : [1, 2, 3, 5, 8],
+                        'label' : ['Mouse', 'Human', 'Zebrafish', 'Chicken', 'Macaque'],
+                        'taxon_id' : [10090, 9606, 7955, 9031, 9544]
+                        }
+    """
+    if sample_attributes.lower() in ["human", "homo sapiens","9606"]:
+        return 2
+    if sample_attributes.lower() in ["mouse","mus musculus", "10090"]:
+        return 1
+    if sample_attributes.lower() in ["zebrafish", "danio rerio", "7955"]:
+        return 3
+    if sample_attributes.lower() in ["chicken", "gallus gallus", "9031"]:
+        return 5
+    #if sample_attributes.lower() in ["macaque", "macaca mulatta", "9544"]:
+    #    return 8
+    log("ERROR", "Could not associate organism or taxon id {} with a gEAR organism ID".format(sample_attributes))
+    return -1
+
+def get_metadata_file(base_dir, dmz_path, metadata_sheet, dtype):
     """
-    Input: A base directory, presumably the extracted tarball of a dataset and the path to archive being processed.
+    Input: A base directory, presumably the extracted tarball of a dataset, the path to archive being processed
+           and the bundle type reported by extract_dataset().
 
     Output: The full path to the file which appears to be the metadata file,
            whether that's an xls or json file
     """
     log('INFO', "Extracting metadata file from base: {0}".format(base_dir))
     file_list = os.listdir(base_dir)
-    # Some files were gzip-compressed before archiving.  Unextract so that "get_archive_type" can catch these
-    file_list = [gunzip_file(filename, base_dir) for filename in file_list]
-    dtype = DataArchive()
-    dtype = dtype.get_archive_type(data_path = base_dir)
+    # Some files were gzip-compressed before archiving.  Unextract so the metadata can be read
+    with concurrent.futures.ThreadPoolExecutor(max_workers=parallelgzip.WORKERS) as pool:
+        file_list = list(pool.map(lambda filename: gunzip_file(filename, base_dir), file_list))
     if dtype == "3tab":
         for filename in file_list:
             if "EXPmeta" in filename:
@@ -364,27 +731,62 @@ def get_organism_id(metadata_path):
             return jdata['taxon_id']
         raise Exception("No taxon id provided in file {}".format(metadata_path, datetime.datetime.now()))
 
-def get_tar_paths_from_database(conn):
-    """Use a database to read out the files."""
-    extensions = ['.mex.tar.gz', '.tab.analysis.tar', '.tab.counts.tar']
+def get_tar_paths_from_database(conn, after=None):
+    """
+    Input: A database connection, and optionally a high-water mark (a value of the derived
+           table's primary key) recorded by an earlier incremental run.
+
+    Output: A (paths, keys) tuple.  paths are the MEX, TABcounts and TABanalysis bundles
+           among the derived records (only those keyed after 'after', if given) and keys
+           maps each path to its record's key, for high_water_mark().
 
+    Only qualifying records are sent by the server, and they are read from a server-side
+    cursor FETCH_SIZE at a time rather than all at once.
+    """
     http_ptrn = config.get("paths", "http_path")
     # Path to "release/public-facing" area
     release_dir_ptrn = os.path.join(config.get("paths", "release_dir"), "brain")
 
-    # Get all "derived" identifier records
-    query = db.select([tables.derived.columns.file_url])
-    result_proxy = conn.execute(query)
+    derived = tables.derived
+    key_columns = list(derived.primary_key.columns)
+    if len(key_columns) != 1:
+        raise Exception("Table {0} needs a single-column primary key for database discovery".format(derived.name))
+    key = key_columns[0]
+
+    query = db.select([key, derived.c.file_url]) \
+            .where(db.or_(*[derived.c.file_url.like('%' + e) for e in DB_EXTENSIONS]))
+    if after is not None:
+        query = query.where(key > after)
 
-    # Iterate through records and only keep MEX, TABcounts, and TABanalysis bundles
     desired_files = []
-    for row in result_proxy:
-        for e in extensions:
-            if row[0].endswith(e):
-                # Replace HTTP URL with "release/public-facing" pathname
-                desired_files.append(row[0].replace(http_ptrn, release_dir_ptrn))
-                break
-    return desired_files
+    keys = dict()
+    for row in stream_rows(conn, query):
+        # LIKE may ignore case depending on the collation, so check the suffix exactly here
+        if row[1].endswith(tuple(DB_EXTENSIONS)):
+            # Replace HTTP URL with "release/public-facing" pathname
+            path = row[1].replace(http_ptrn, release_dir_ptrn)
+            desired_files.append(path)
+            keys[path] = max(row[0], keys.get(path, row[0]))
+    return desired_files, keys
+
+def high_water_mark(keys, failed_paths, after=None):
+    """
+    Input: The {path: key} of the bundles get_tar_paths_from_database() found, the paths
+           that failed this run and the mark they were found after.
+
+    Output: The mark for the next incremental run: the largest key below every failed
+           bundle's, so failures are fetched and retried next time.  'after' if there is
+           no such key.
+    """
+    failed = [keys[path] for path in failed_paths if path in keys]
+    if failed:
+        lowest = min(failed)
+        candidates = [key for key in keys.values() if key < lowest]
+    else:
+        candidates = list(keys.values())
+    if not candidates:
+        return after
+    return max(candidates)
 
 def get_tar_paths_from_dir(base_dir):
     tar_list = list()
@@ -395,24 +797,66 @@ def get_tar_paths_from_dir(base_dir):
 
 def get_tar_paths_from_manifest(lines):
     """Iterate through manifest filehandle to retrieve tar files that fit the formats desired."""
-    extensions = ['.mex.tar.gz', '.tab.analysis.tar', '.tab.counts.tar', '.h5ad.tar']
+    return [path for path, size, mtime in iter_manifest_bundles(lines)]
 
-    def is_good_file(filename):
-        """Does file end with a desired file extension?"""
-        for e in extensions:
-            if filename.endswith(e):
-                return True
-        return False
+def iter_manifest_bundles(lines):
+    """
+    Input: The lines of a DMZ inventory manifest (`ls -l` output), e.g. an open file.
+
+    Output: Yields a (path, size, mtime) tuple for each bundle of a format we process.
+           mtime is the date/time text as `ls` printed it.  size and mtime are None for
+           lines without the usual `ls -l` columns.
+    """
+    extensions = ('.mex.tar.gz', '.tab.analysis.tar', '.tab.counts.tar', '.h5ad.tar')
 
     # Path to "release/public-facing" area
     release_dir = config.get("paths", "release_dir")
 
-    # Extract files out of the `ls -l` output
-    files = [line.split()[-1] for line in lines]
-    # Only keep files with extensions we care about
-    desired_files = filter(is_good_file, files)
-    # Manifest file paths were relative to a specific directory, so add the directory back
-    return [os.path.join(release_dir, f) for f in desired_files]
+    for line in lines:
+        line = line.rstrip("\n")
+        # mode, links, owner, group, size, month, day, time or year, name
+        fields = line.split(None, 8)
+        if len(fields) == 9 and fields[4].isdigit():
+            filename, size, mtime = fields[8], int(fields[4]), " ".join(fields[5:8])
+        elif fields:
+            filename, size, mtime = fields[-1], None, None
+        else:
+            continue
+        # Only keep files with extensions we care about
+        if filename.endswith(extensions):
+            # Manifest file paths were relative to a specific directory, so add the directory back
+            yield os.path.join(release_dir, filename), size, mtime
+
+def diff_manifest(lines, snapshot):
+    """
+    Input: The lines of a DMZ inventory manifest and the {path: (size, mtime)} snapshot of
+           the previous one (IngestState.manifest_snapshot()).
+
+    Output: A (changed, removed) tuple.  changed lists (path, size, mtime) for bundles which
+           are new or whose size or mtime differ from the snapshot, in manifest order, and
+           removed lists the snapshot paths no longer in the manifest.
+
+    The manifest is read line by line and only the bundles' entries are held.
+    """
+    changed = list()
+    seen = set()
+    for path, size, mtime in iter_manifest_bundles(lines):
+        seen.add(path)
+        previous = snapshot.get(path)
+        if previous is None or previous[0] != size or not _same_mtime(previous[1], mtime):
+            changed.append((path, size, mtime))
+    removed = [path for path in snapshot if path not in seen]
+    return changed, removed
+
+def _same_mtime(old, new):
+    # `ls -l` prints the time of day for recent files and the year for older ones, so the
+    # same mtime can show up as 'Jan 3 12:00' one week and 'Jan 3 2020' months later
+    if old == new:
+        return True
+    if old is None or new is None:
+        return False
+    old, new = old.split(), new.split()
+    return old[:2] == new[:2] and ':' in old[-1] and ':' not in new[-1]
 
 def gunzip_file(gzip_file, base_dir):
     """Run "gunzip" on a file and return the extracted filename."""
@@ -420,9 +864,7 @@ def gunzip_file(gzip_file, base_dir):
     if not gzip_file.endswith(".gz"):
         return gzip_file
     gunzip_file = full_gzip_file.replace(".gz", "")
-    with gzip.open(full_gzip_file, 'rb') as f_in:
-        with open(gunzip_file, 'wb') as f_out:
-            shutil.copyfileobj(f_in, f_out)
+    parallelgzip.gunzip(full_gzip_file, gunzip_file)
     # Now that file is extracted.  Remove file
     os.remove(full_gzip_file)
 
@@ -432,15 +874,6 @@ def gunzip_file(gzip_file, base_dir):
 def log(level, msg):
     print("{0}: {1}".format(level, msg),  flush=True)
 
-def prepend(filelist, input_dir):
-    """
-    Input: List of files in the input directory and path to input directory
-
-    Output: List of full paths to log files in input directory
-    """
-    input_dir += '{0}'
-    return [input_dir.format(i) for i in filelist]
-
 def run_command(cmd):
     log("INFO", "Running command: {0}".format(cmd))
     return_code = subprocess.call(cmd, shell=True)
@@ -448,8 +881,10 @@ def run_command(cmd):
        raise Exception("ERROR: [{2}] Return code {0} when running the following command: {1}".format(return_code, cmd, datetime.datetime.now()))
 
 def setup_logger():
-    """Set up the logger."""
+    """Set up the logger.  Safe to call more than once; the file handler is only added the first time."""
     logger = logging.getLogger('tracking_log')
+    if logger.handlers:
+        return logger
     logger.setLevel(logging.INFO)
     #Where to Store needs to be identified?
     f_handler = logging.FileHandler(PROCESSED_LOGFILE, mode='a', encoding = None, delay = False)
@@ -459,26 +894,56 @@ def setup_logger():
     logger.addHandler(f_handler)
     return logger
 
-def setup_mysql(host, database, user, pw):
-    """Connect to MySQL and return database object."""
-    engine = db.create_engine('mysql+pymysql://{}:{}@{}:3306/{}'.format(user, pw, host, database))
-    tables.create_tables(engine)
+def get_database_url():
+    """
+    The [mysql] url config entry if there is one (any SQLAlchemy URL, such as
+    sqlite:////path/to/identifiers.sqlite for a local copy), otherwise the MySQL URL built
+    from ip, db, user and pass.
+    """
+    url = config.get("mysql", "url", fallback=None)
+    if url:
+        return url
+    return 'mysql+pymysql://{}:{}@{}:3306/{}'.format(config.get("mysql", "user"), config.get("mysql", "pass"),
+                                                     config.get("mysql", "ip"), config.get("mysql", "db"))
+
+def setup_mysql(url, create_tables=False):
+    """Connect to the identifiers database and return a connection, creating the tables first if asked."""
+    engine = db.create_engine(url, pool_pre_ping=True)
+    if create_tables:
+        tables.create_tables(engine)
     return engine.connect()
 
-def upload_to_cloud(bucket, h5_path, metadata_json_path):
+def stream_rows(conn, query, fetch_size=FETCH_SIZE):
+    """Yield the rows of a query from a server-side cursor, fetch_size rows per round trip."""
+    result_proxy = conn.execution_options(stream_results=True).execute(query)
+    try:
+        while True:
+            rows = result_proxy.fetchmany(fetch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield row
+    finally:
+        result_proxy.close()
+
+def upload_to_cloud(uploader, h5_path, metadata_json_path, metrics=None, dataset_id=None):
     """
-    Input: Paths to both H5 and metadata files to be uploaded to a gEAR cloud instance
+    Input: A gcs_transfer.Uploader and paths to both H5 and metadata files to be uploaded
+           to a gEAR cloud instance, and optionally ingest_metrics.Metrics to time the
+           upload in (as the dataset's 'upload' stage)
+
+    Output: A future which completes once both files are in the bucket and their CRC32Cs
+           have been verified.  It raises if either upload failed.
 
-    Output: Files uploaded to GCloud.  No values returned.
+    The JSON is sent first since the processor picks datasets up by their .h5ad, and the
+    uploads of different datasets run concurrently in the uploader's pool.
 
     Further docs:
       https://cloud.google.com/python/getting-started/using-cloud-storage
     """
     log('INFO', 'Uploading these files to the cloud bucket: {0}, {1}'.format(h5_path, metadata_json_path))
-    for filename in [h5_path, metadata_json_path]:
-        blob = bucket.blob(os.path.basename(filename))
-        blob.upload_from_filename(filename)
+    timer = metrics.stage(dataset_id, 'upload') if metrics is not None else None
+    return uploader.submit([metadata_json_path, h5_path], timer)
 
 if __name__ == '__main__':
-    main()
-    sys.exit()
+    sys.exit(main())
@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+
+Checks that nemo_upload_crawler.py converts and uploads byte-identical bundles only once
+when they are processed concurrently.
+
+Copies the given bundle several times into a scratch input directory (the copies get
+distinct paths, so distinct ingest records, but the same MD5), runs the crawler over it
+with several workers and a fresh state database, then checks that every copy ended up
+'uploaded' under a single dataset ID: one upload, the rest duplicates.
+
+Test commands:
+
+export GOOGLE_APPLICATION_CREDENTIALS=$HOME/keys/nemo-analytics__archive-file-transfer.json
+export PYTHONPATH=$HOME/git/gEAR/lib:$PYTHONPATH
+./test_duplicate_bundles.py -b /local/scratch/achatterjee/MEX_TEST/IN/sample.mex.tar.gz -ob ./
+
+"""
+
+import argparse, os, sys
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+
+CRAWLER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "nemo_upload_crawler.py")
+
+def main():
+    parser = argparse.ArgumentParser( description='Check concurrent deduplication of identical bundles')
+    parser.add_argument('-b', '--bundle', type=str, required=True, help='Path to a bundle tarball the crawler can process')
+    parser.add_argument('-ob', '--output_base', type=str, required=True, help='Path to a local output directory for the crawler')
+    parser.add_argument('-n', '--copies', type=int, default=4, help='Number of identical copies of the bundle to process (default: 4)')
+    parser.add_argument('-w', '--workers', type=int, default=3, help='Number of crawler workers (default: 3)')
+    parser.add_argument('-s', '--metadata_xls', help='Path to a Excel-formatted spreadsheet of metadata, for MEX bundles')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(dir=args.output_base)
+    try:
+        input_dir = os.path.join(scratch, "in")
+        os.mkdir(input_dir)
+        name = os.path.basename(args.bundle)
+        for i in range(args.copies):
+            shutil.copy(args.bundle, os.path.join(input_dir, "copy{0}.{1}".format(i, name)))
+
+        state_db = os.path.join(scratch, "ingest_state.sqlite")
+        cmd = [sys.executable, CRAWLER, '-id', input_dir, '-ob', args.output_base,
+               '-w', str(args.workers), '--state_db', state_db]
+        if args.metadata_xls:
+            cmd += ['-s', args.metadata_xls]
+        subprocess.run(cmd, check=True)
+
+        conn = sqlite3.connect(state_db)
+        rows = conn.execute("SELECT source_path, dataset_id, stage FROM bundles").fetchall()
+        conn.close()
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+    for source_path, dataset_id, stage in rows:
+        print("{0}\t{1}\t{2}".format(source_path, dataset_id, stage))
+    dataset_ids = set(row[1] for row in rows)
+    if len(rows) != args.copies or any(row[2] != 'uploaded' for row in rows):
+        sys.exit("FAIL: expected {0} uploaded bundles".format(args.copies))
+    if len(dataset_ids) != 1:
+        sys.exit("FAIL: identical bundles were uploaded as {0} datasets: {1}".format(len(dataset_ids), ", ".join(sorted(dataset_ids))))
+    print("OK: {0} identical bundles share dataset {1}".format(args.copies, dataset_ids.pop()))
+
+if __name__ == '__main__':
+    main()
@@ -22,22 +22,28 @@ import subprocess
 import uuid
 
 from google.cloud import storage
+import gcs_batch
 GCLOUD_PROJECT = 'nemo-analytics'
 GCLOUD_BUCKET = 'nemo-analytics-incoming'
 
 def main():
     parser = argparse.ArgumentParser( description='NeMO data processor for gEAR')
+    parser.add_argument('blob_names', nargs='*', default=['8eb9cd46-a5c8-40e6-983b-8809eb1201cc.h5ad'], help='Names of the objects to print the properties of')
     args = parser.parse_args()
 
     sclient = storage.Client(project=GCLOUD_PROJECT)
     bucket = storage.bucket.Bucket(client=sclient, name=GCLOUD_BUCKET)
 
-    blob = bucket.get_blob('8eb9cd46-a5c8-40e6-983b-8809eb1201cc.h5ad')
+    blobs = [bucket.blob(name) for name in args.blob_names]
 
     #reload call is required for some attributes to be populated
     # https://news.ycombinator.com/item?id=17516153
-    blob.reload()
-    blob_metadata(blob)
+    # All of the reloads go in batch requests rather than one round trip per blob
+    found = gcs_batch.reload_blobs(sclient, blobs)
+    for blob in found:
+        blob_metadata(blob)
+    for name in sorted(set(args.blob_names) - set(blob.name for blob in found)):
+        print("Blob not found: {}".format(name))
     
 def blob_metadata(blob):
     """Prints out a blob's metadata."""
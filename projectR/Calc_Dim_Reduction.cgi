@@ -1,6 +1,21 @@
 #!/opt/bin/python3
 
 """
+Queues the reference PCs for an analysis (uns['DimReduction'] and uns['DimReductionGene'],
+read by projection.py) and reports on their progress.  The PCA itself runs in
+dimreduction_worker.py, which keeps scanpy loaded between requests; this script only
+touches the job queue (jobqueue.py) and returns straight away.
+
+Submitting: analysis_id, analysis_type, dataset_id and session_id, plus the optional
+n_comps (default 50), solver (arpack, randomized or incremental; default randomized),
+n_top_genes (restrict to the most highly variable genes) and save_dataset (default 1).
+An identical request from the same session that is already queued, running or done
+returns the same job, unless the dataset file has changed since it finished.
+
+Polling: job_id and session_id.
+
+Both return the job: {'success': 1, 'job_id': ..., 'status': 'queued' | 'running' |
+'done' | 'failed', 'result': ..., 'error': ...}
 """
 
 import cgi, json
@@ -13,48 +28,54 @@ lib_path = os.path.abspath(os.path.join('..', '..', 'lib'))
 sys.path.append(lib_path)
 import geardb
 
-import scanpy as sc
-sc.settings.verbosity = 0
+import jobqueue
+
+N_COMPS = 50
 
 def main():
     form = cgi.FieldStorage()
+    job_id = form.getvalue('job_id')
     analysis_id = form.getvalue('analysis_id')
     analysis_type = form.getvalue('analysis_type')
     dataset_id = form.getvalue('dataset_id')
     session_id = form.getvalue('session_id')
     user = geardb.get_user_from_session_id(session_id)
 
-    ana = geardb.Analysis(id=analysis_id, type=analysis_type, dataset_id=dataset_id, 
-                          session_id=session_id, user_id=user.id)
-
-    adata = ana.get_adata()
-
-    sc.tl.pca(adata, zero_center=True) 
-
-    adata.uns['DimReduction'] = adata.obsm.X_pca  ## this is cells X PC 
-
-    adata.uns['DimReductionGene'] = adata.varm['PCs'] ## this is genes X PC 
-
-    dest_datafile_path = None #? 
-    
-    # primary or public analyses won't be after this
-    if ana.type == 'primary' or ana.type == 'public':
-        ana.type = 'user_unsaved'
-
-    dest_datafile_path = ana.dataset_path()
-    dest_directory = os.path.dirname(dest_datafile_path)
-
-    if not os.path.exists(dest_directory):
-        os.makedirs(dest_directory)
-
-    if save_dataset:
-
-        adata.write(dest_datafile_path)
+    queue = jobqueue.JobQueue()
+    if job_id:
+        try:
+            job = queue.status(int(job_id))
+        except ValueError:
+            # Not a job ID at all
+            job = None
+        if job is None or job['user_id'] != user.id:
+            result = {'success': 0, 'error': "No such job: {0}".format(job_id)}
+        else:
+            result = job_result(job)
+    else:
+        n_top_genes = form.getvalue('n_top_genes')
+        params = {'n_comps': int(form.getvalue('n_comps', N_COMPS)),
+                  'solver': form.getvalue('solver', 'randomized'),
+                  'n_top_genes': int(n_top_genes) if n_top_genes else None,
+                  'save_dataset': form.getvalue('save_dataset', '1') not in ('0', 'false')}
+
+        ana = geardb.Analysis(id=analysis_id, type=analysis_type, dataset_id=dataset_id,
+                              session_id=session_id, user_id=user.id)
+        source_path = ana.dataset_path()
+        job = queue.submit(dataset_id, analysis_id, analysis_type, user.id, params,
+                           est_bytes=jobqueue.estimate_bytes(source_path), session_id=session_id,
+                           source_mtime=jobqueue.file_mtime(source_path))
+        result = job_result(job)
+    queue.close()
 
     sys.stdout = original_stdout
     print('Content-Type: application/json\n\n')
     print(json.dumps(result))
 
+def job_result(job):
+    return {'success': 1, 'job_id': job['id'], 'status': job['status'],
+            'result': job['result'], 'error': job['error']}
+
 
 if __name__ == '__main__':
     main()
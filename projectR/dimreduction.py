@@ -0,0 +1,188 @@
+"""
+
+PCA backend for Calc_Dim_Reduction.cgi that never densifies X.
+
+sc.tl.pca(adata, zero_center=True) has to densify a sparse matrix (or fall back to a full
+solver) to subtract the gene means.  Here the centering is implicit: the centered matrix
+X - 1 mu' is only ever applied to vectors, as X @ v - mu.v, so X stays sparse and the
+SVD costs a few sparse products per component.
+
+Solvers:
+
+  * arpack      - truncated SVD of the implicitly centered matrix (scipy svds)
+  * randomized  - randomized range finder + small dense SVD (Halko et al.), also
+                  implicitly centered.  Usually the fastest for tens of components.
+  * incremental - IncrementalPCA over blocks of cells, for backed AnnData where X is
+                  still on disk.  Only one block is dense in memory at a time.
+
+Optionally only the n most highly variable genes (by mean-normalized dispersion) are
+used.  Their loadings are scattered back into a genes x PCs matrix with zero rows for
+the other genes, the same layout scanpy's use_highly_variable gives.
+
+    import dimreduction
+    dimreduction.run_pca(adata, n_comps=50, solver='randomized', n_top_genes=2000)
+    adata.uns['DimReduction']       # cells x PCs
+    adata.uns['DimReductionGene']   # genes x PCs
+
+"""
+
+import numpy as np
+import scipy.sparse
+import scipy.sparse.linalg
+
+SOLVERS = ['arpack', 'randomized', 'incremental']
+N_COMPS = 50
+# Cells per block when a backed matrix is read in pieces
+BLOCK_SIZE = 50000
+# Most float64 values (cells x genes used) densified at once by the incremental solver, 512 MB
+DENSE_BLOCK_VALUES = 64 * 1024 * 1024
+# Extra random vectors and power iterations for the randomized solver
+OVERSAMPLES = 10
+POWER_ITERATIONS = 4
+
+
+def run_pca(adata, n_comps=N_COMPS, solver='randomized', n_top_genes=None, random_state=0,
+            block_size=BLOCK_SIZE):
+    """
+    Input: An AnnData (in memory or backed), the number of components, a solver from
+           SOLVERS and, optionally, how many highly variable genes to restrict to.
+
+    Output: Nothing returned.  Adds obsm['X_pca'], varm['PCs'] and uns['pca'] as
+           sc.tl.pca would, plus uns['DimReduction'] (cells x PCs) and
+           uns['DimReductionGene'] (genes x PCs) for projectR.
+    """
+    if solver not in SOLVERS:
+        raise Exception("Unknown PCA solver {0}.  Expected one of: {1}".format(solver, ", ".join(SOLVERS)))
+    if adata.isbacked and solver != 'incremental':
+        # Only the incremental solver reads a backed X in blocks
+        solver = 'incremental'
+
+    mean, var = gene_stats(adata.X, block_size)
+    genes = np.arange(adata.n_vars)
+    if n_top_genes and n_top_genes < adata.n_vars:
+        genes = highly_variable_genes(mean, var, n_top_genes)
+    n_comps = min(n_comps, adata.n_obs - 1, len(genes) - 1)
+    if n_comps < 1:
+        raise Exception("Too few cells or genes for PCA: {0} x {1}".format(adata.n_obs, len(genes)))
+
+    if solver == 'incremental':
+        embedding, components, variance = _incremental_pca(adata.X, genes, n_comps, block_size)
+    else:
+        X = adata.X if len(genes) == adata.n_vars else adata.X[:, genes]
+        X = scipy.sparse.csr_matrix(X) if scipy.sparse.issparse(X) else np.asarray(X)
+        if solver == 'arpack':
+            u, s, vt = _arpack_svd(X, mean[genes], n_comps, random_state)
+        else:
+            u, s, vt = _randomized_svd(X, mean[genes], n_comps, random_state)
+        u, vt = _flip_signs(u, vt)
+        embedding = u * s
+        components = vt
+        variance = s ** 2 / (adata.n_obs - 1)
+
+    loadings = np.zeros((adata.n_vars, n_comps), dtype=np.float64)
+    loadings[genes] = components.T
+
+    adata.obsm['X_pca'] = embedding
+    adata.varm['PCs'] = loadings
+    adata.uns['pca'] = {'variance': variance, 'variance_ratio': variance / var[genes].sum(),
+                        'params': {'zero_center': True, 'solver': solver, 'n_top_genes': n_top_genes}}
+    adata.uns['DimReduction'] = embedding
+    adata.uns['DimReductionGene'] = loadings
+
+def gene_stats(X, block_size=BLOCK_SIZE):
+    """
+    Per-gene mean and (sample) variance of X, computed over blocks of cells so a backed
+    matrix is never read whole.
+    """
+    n_obs, n_vars = X.shape
+    total = np.zeros(n_vars, dtype=np.float64)
+    total_sq = np.zeros(n_vars, dtype=np.float64)
+    for start in range(0, n_obs, block_size):
+        block = X[start:start + block_size]
+        if scipy.sparse.issparse(block):
+            total += np.asarray(block.sum(axis=0)).ravel()
+            total_sq += np.asarray(block.multiply(block).sum(axis=0)).ravel()
+        else:
+            block = np.asarray(block, dtype=np.float64)
+            total += block.sum(axis=0)
+            total_sq += (block ** 2).sum(axis=0)
+    mean = total / n_obs
+    var = (total_sq - n_obs * mean ** 2) / max(n_obs - 1, 1)
+    return mean, np.maximum(var, 0)
+
+def highly_variable_genes(mean, var, n_top_genes):
+    """Indexes (in var order) of the n_top_genes genes with the highest variance / mean."""
+    dispersion = np.zeros_like(mean)
+    expressed = mean > 0
+    dispersion[expressed] = var[expressed] / mean[expressed]
+    return np.sort(np.argsort(-dispersion, kind='stable')[:n_top_genes])
+
+def _centered_operator(X, mean):
+    # X - 1 mu' applied without ever forming it
+    n_obs = X.shape[0]
+    return scipy.sparse.linalg.LinearOperator(
+        shape=X.shape, dtype=np.float64,
+        matvec=lambda v: X @ np.ravel(v) - mean @ np.ravel(v),
+        matmat=lambda V: np.asarray(X @ V) - np.outer(np.ones(n_obs), mean @ V),
+        rmatvec=lambda u: X.T @ np.ravel(u) - mean * np.ravel(u).sum(),
+        rmatmat=lambda U: np.asarray(X.T @ U) - np.outer(mean, U.sum(axis=0)))
+
+def _arpack_svd(X, mean, n_comps, random_state):
+    op = _centered_operator(X, mean)
+    v0 = np.random.RandomState(random_state).uniform(-1, 1, min(X.shape))
+    u, s, vt = scipy.sparse.linalg.svds(op, k=n_comps, solver='arpack', v0=v0)
+    # svds returns the singular values in ascending order
+    order = np.argsort(-s)
+    return u[:, order], s[order], vt[order]
+
+def _randomized_svd(X, mean, n_comps, random_state):
+    op = _centered_operator(X, mean)
+    rng = np.random.RandomState(random_state)
+    n_random = min(n_comps + OVERSAMPLES, min(X.shape))
+
+    Q = op.matmat(rng.normal(size=(X.shape[1], n_random)))
+    for _ in range(POWER_ITERATIONS):
+        Q, _ = np.linalg.qr(Q)
+        Q, _ = np.linalg.qr(op.rmatmat(Q))
+        Q = op.matmat(Q)
+    Q, _ = np.linalg.qr(Q)
+
+    B = op.rmatmat(Q).T
+    u_small, s, vt = np.linalg.svd(B, full_matrices=False)
+    u = Q @ u_small
+    return u[:, :n_comps], s[:n_comps], vt[:n_comps]
+
+def _incremental_pca(X, genes, n_comps, block_size):
+    # sklearn comes with scanpy
+    from sklearn.decomposition import IncrementalPCA
+
+    n_obs = X.shape[0]
+    # Blocks are densified over the genes used, so keep cells x genes within the budget.
+    # Every partial_fit needs at least n_comps cells.
+    block_size = max(min(block_size, DENSE_BLOCK_VALUES // max(len(genes), 1)), n_comps)
+    ipca = IncrementalPCA(n_components=n_comps)
+    for start in range(0, n_obs, block_size):
+        if n_obs - start - block_size < n_comps:
+            # Fold a short final block into this one
+            ipca.partial_fit(_dense_block(X, start, n_obs, genes))
+            break
+        ipca.partial_fit(_dense_block(X, start, start + block_size, genes))
+
+    embedding = np.zeros((n_obs, n_comps), dtype=np.float64)
+    for start in range(0, n_obs, block_size):
+        end = min(start + block_size, n_obs)
+        embedding[start:end] = ipca.transform(_dense_block(X, start, end, genes))
+    return embedding, ipca.components_, ipca.explained_variance_
+
+def _dense_block(X, start, end, genes):
+    block = X[start:end]
+    if scipy.sparse.issparse(block):
+        # Pick the genes while still sparse so only cells x genes used is densified
+        return block.tocsr()[:, genes].toarray().astype(np.float64, copy=False)
+    return np.asarray(block[:, genes], dtype=np.float64)
+
+def _flip_signs(u, vt):
+    # Same convention as scanpy/sklearn: the largest |loading| of each component is positive
+    signs = np.sign(vt[np.arange(vt.shape[0]), np.argmax(np.abs(vt), axis=1)])
+    signs[signs == 0] = 1
+    return u * signs, vt * signs[:, None]
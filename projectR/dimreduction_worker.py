@@ -0,0 +1,141 @@
+#!/opt/bin/python3
+
+"""
+
+Long-running service that runs the dimension-reduction jobs Calc_Dim_Reduction.cgi
+queues (see jobqueue.py).
+
+scanpy, the gEAR libraries and the PCA backend are imported once when the service starts,
+rather than on every web request.  Jobs run on a pool of threads (the heavy lifting is in
+numpy/scipy, which release the GIL).  A job is only started when its memory estimate fits
+in what is left of --memory_gb after the jobs already running, and never more than
+--workers at once.
+
+Test command:
+
+./dimreduction_worker.py --memory_gb 16 --workers 2
+
+"""
+
+import argparse
+import concurrent.futures
+import datetime
+import os
+import sys
+import threading
+import time
+import traceback
+
+lib_path = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'lib'))
+sys.path.append(lib_path)
+import geardb
+
+import scanpy as sc
+sc.settings.verbosity = 0
+
+import dimreduction
+import h5adpartial
+import jobqueue
+
+# Elements run_pca() adds, and so all a saved analysis needs written
+PCA_ELEMENTS = ['obsm/X_pca', 'varm/PCs', 'uns/pca', 'uns/DimReduction', 'uns/DimReductionGene']
+
+# Seconds between looks at the queue when there's nothing to start
+POLL_INTERVAL = 2
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Run queued dimension-reduction jobs')
+    parser.add_argument('--db', type=str, default=jobqueue.JOB_DB, help='Path to the job queue database (default: {0})'.format(jobqueue.JOB_DB))
+    parser.add_argument('-w', '--workers', type=int, default=2, help='Most jobs to run at once (default: 2)')
+    parser.add_argument('-m', '--memory_gb', type=float, default=16, help='Memory the running jobs may use between them, in GB (default: 16)')
+    parser.add_argument('--once', action='store_true', help='Exit once the queue is empty instead of waiting for more jobs')
+    args = parser.parse_args()
+
+    queue = jobqueue.JobQueue(args.db)
+    requeued = queue.requeue_orphans()
+    if requeued:
+        log('INFO', "Requeued {0} jobs left running by a previous worker".format(requeued))
+
+    budget = int(args.memory_gb * 1024 ** 3)
+    running = dict()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=args.workers) as pool:
+        while True:
+            for future in [f for f in running if f.done()]:
+                del running[future]
+            free = budget - sum(running.values())
+            job = queue.claim(free) if len(running) < args.workers else None
+            if job is None and not running:
+                # Nothing is running, so a job bigger than the whole budget gets to run on
+                # its own rather than sitting in the queue forever
+                job = queue.claim(float('inf'))
+            if job:
+                log('INFO', "Starting job {0} (dataset {1}, {2})".format(job['id'], job['dataset_id'], job['params']))
+                running[pool.submit(run_job, queue, job)] = job['est_bytes']
+                continue
+            if args.once and not running:
+                break
+            time.sleep(POLL_INTERVAL)
+    queue.close()
+
+def run_job(queue, job):
+    """
+    Input: The queue and a claimed job.
+
+    Output: Nothing returned.  The job is marked done with its result, or failed with the
+           error.
+    """
+    try:
+        result = reduce_dataset(job['dataset_id'], job['analysis_id'], job['analysis_type'],
+                                job['user_id'], job['session_id'], job['params'])
+        queue.finish(job['id'], result)
+        log('INFO', "Finished job {0}".format(job['id']))
+    except Exception as err:
+        queue.fail(job['id'], err)
+        log('ERROR', "Job {0} failed: {1}\n{2}".format(job['id'], err, traceback.format_exc()))
+
+def reduce_dataset(dataset_id, analysis_id, analysis_type, user_id, session_id, params):
+    """
+    Input: The analysis to reduce, the user and session it belongs to and run_pca() params
+           (n_comps, solver, n_top_genes, save_dataset).
+
+    Output: The result dict returned to the CGI.  uns['DimReduction'] and
+           uns['DimReductionGene'] are saved to the analysis's dataset unless
+           save_dataset is false.
+    """
+    ana = geardb.Analysis(id=analysis_id, type=analysis_type, dataset_id=dataset_id,
+                          session_id=session_id, user_id=user_id)
+    solver = params.get('solver', 'randomized')
+    adata = ana.get_adata(backed=(solver == 'incremental'))
+
+    ## uns['DimReduction'] is cells X PC, uns['DimReductionGene'] is genes X PC
+    dimreduction.run_pca(adata, n_comps=params.get('n_comps', dimreduction.N_COMPS), solver=solver,
+                         n_top_genes=params.get('n_top_genes'))
+
+    # primary or public analyses won't be after this
+    if ana.type == 'primary' or ana.type == 'public':
+        ana.type = 'user_unsaved'
+
+    dest_datafile_path = ana.dataset_path()
+    dest_directory = os.path.dirname(dest_datafile_path)
+
+    if not os.path.exists(dest_directory):
+        os.makedirs(dest_directory)
+
+    if params.get('save_dataset', True):
+        # Only the new arrays are written if the analysis file already exists
+        h5adpartial.save_elements(adata, dest_datafile_path, PCA_ELEMENTS)
+
+    return {'success': 1, 'analysis_type': ana.type, 'n_comps': adata.uns['DimReduction'].shape[1],
+            'solver': adata.uns['pca']['params']['solver'],
+            'variance_ratio': adata.uns['pca']['variance_ratio'].tolist()}
+
+LOG_LOCK = threading.Lock()
+
+def log(level, msg):
+    with LOG_LOCK:
+        print("{0} - {1}: {2}".format(level, datetime.datetime.now(), msg), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,82 @@
+"""
+
+Reading gene identifiers out of H5ADs and lining reference loadings up with a test
+dataset's genes.  Shared by projection.py and refcache.py.
+
+    genes = genematch.read_var_column(h5, 'gene_symbol')
+    aligned = genematch.align_loadings(test_genes, ref_genes, loadings)
+
+"""
+
+import h5py
+import numpy as np
+import pandas as pd
+
+
+def read_var_column(h5, column=None, group='var'):
+    """
+    Input: An open H5AD, a var column name (None for the index) and the dataframe group.
+
+    Output: A pandas Index of strings.  Falls back to the index if the column isn't there.
+           Handles both the current layout (a group of column datasets, categoricals stored
+           as codes + categories) and the compound-dataset layout of older H5ADs.
+    """
+    node = h5[group]
+    if isinstance(node, h5py.Dataset):
+        names = node.dtype.names
+        field = column if column in names else 'index'
+        return pd.Index(_decode(node[field]))
+
+    index_key = attr_str(node.attrs.get('_index', 'index'))
+    if column is None or column not in node:
+        column = index_key
+    values = node[column]
+    if isinstance(values, h5py.Group):
+        # Categorical: codes into categories
+        categories = _decode(values['categories'][()])
+        return pd.Index(categories[values['codes'][()]])
+    if 'categories' in values.attrs:
+        # anndata 0.7 categoricals reference their categories by object ref
+        categories = _decode(h5[values.attrs['categories']][()])
+        return pd.Index(categories[values[()]])
+    return pd.Index(_decode(values[()]))
+
+def align_loadings(test_genes, ref_genes, loadings):
+    """
+    Input: The test dataset's genes, the reference genes and the reference loadings
+           (ref genes x PCs).
+
+    Output: Loadings scattered into test gene order (test genes x PCs).  Rows for test
+           genes with no reference match are zero, as are repeats of a gene already
+           matched, so each shared gene is counted once like projectR's intersect().
+    """
+    ref_index = pd.Index(ref_genes)
+    keep = ~ref_index.duplicated()
+    ref_index = ref_index[keep]
+    loadings = loadings[keep]
+
+    positions = ref_index.get_indexer(pd.Index(test_genes))
+    matched = (positions >= 0) & ~pd.Index(test_genes).duplicated()
+    if not matched.any():
+        raise Exception("The test and reference datasets have no genes in common")
+
+    aligned = np.zeros((len(test_genes), loadings.shape[1]), dtype=np.float64)
+    aligned[matched] = loadings[positions[matched]]
+    return aligned
+
+def var_columns(h5):
+    """Names of the var columns of an open H5AD, in either on-disk layout."""
+    var = h5['var']
+    if isinstance(var, h5py.Dataset):
+        return list(var.dtype.names)
+    return list(var.keys())
+
+def attr_str(value):
+    """An HDF5 attribute value as str (h5py may hand back bytes)."""
+    return value.decode() if isinstance(value, bytes) else str(value)
+
+def _decode(values):
+    values = np.asarray(values)
+    if values.dtype.kind in ('S', 'O'):
+        return np.array([v.decode() if isinstance(v, bytes) else str(v) for v in values], dtype=object)
+    return values.astype(str).astype(object)
@@ -0,0 +1,132 @@
+"""
+
+Write or replace individual uns/obsm/varm entries of an H5AD in place.
+
+Saving a new analysis result with adata.write() rewrites X, obs, var and every other
+element just to add a couple of arrays.  update_h5ad() opens the file with h5py and only
+writes the elements given, so saving costs the size of the new arrays.
+
+Every element is first written under a temporary name (.<name>.partial) next to where it
+belongs.  Only once all of them are written are the old elements deleted and the new ones
+renamed into place, so a failure part-way through leaves the file as it was apart from
+some .partial leftovers, which the next update overwrites.
+
+Elements are written with anndata's on-disk encoding (encoding-type/encoding-version
+attrs), so the file still reads with anndata.read_h5ad.  Supported values: numeric and
+string arrays, scalars, strings and (nested) dicts of those.
+
+    h5adpartial.update_h5ad(path, {'uns/DimReduction': embedding, 'varm/PCs': loadings})
+    h5adpartial.save_elements(adata, path, ['uns/DimReduction', 'obsm/X_pca'])
+
+"""
+
+import os
+
+import h5py
+import numpy as np
+
+# Top-level groups elements may be written into
+GROUPS = ['uns', 'obsm', 'varm']
+
+
+def update_h5ad(path, elements):
+    """
+    Input: Path to an existing H5AD and a dict of '<group>/<name>' -> value, where group
+           is one of GROUPS.
+
+    Output: Nothing returned.  Each element is written (or replaced) in the file.  obsm
+           values must have a row per cell and varm values a row per gene.
+    """
+    with h5py.File(path, 'r+') as h5:
+        n_rows = {'obsm': _n_rows(h5, 'obs'), 'varm': _n_rows(h5, 'var')}
+        staged = list()
+        for key, value in elements.items():
+            parent, name = key.rsplit('/', 1)
+            if parent.split('/')[0] not in GROUPS:
+                raise Exception("Can only update elements under {0}, not {1}".format(", ".join(GROUPS), key))
+            if parent in n_rows and np.shape(value)[0] != n_rows[parent]:
+                raise Exception("{0} has {1} rows but the dataset has {2}".format(key, np.shape(value)[0], n_rows[parent]))
+
+            group = require_group(h5, parent)
+            tmp_name = ".{0}.partial".format(name)
+            if tmp_name in group:
+                del group[tmp_name]
+            write_element(group, tmp_name, value)
+            staged.append((group, tmp_name, name))
+
+        for group, tmp_name, name in staged:
+            swap(group, tmp_name, name)
+
+def save_elements(adata, path, keys):
+    """
+    Input: An AnnData, the H5AD to save to and the '<group>/<name>' keys of the elements
+           that changed.
+
+    Output: Nothing returned.  If path exists only those elements are written into it;
+           otherwise the whole AnnData is written there with adata.write().
+    """
+    if not os.path.isfile(path):
+        adata.write(path)
+        return
+
+    elements = dict()
+    for key in keys:
+        parent, name = key.split('/', 1)
+        elements[key] = getattr(adata, parent)[name]
+    if adata.isbacked and os.path.samefile(adata.filename, path):
+        # Release anndata's read-only handle before reopening the file for writing
+        adata.file.close()
+    update_h5ad(path, elements)
+
+def require_group(h5, path):
+    """The group at path (e.g. 'uns/projection'), created with anndata's dict encoding if needed."""
+    group = h5
+    for name in path.split('/'):
+        group = group.require_group(name)
+        if 'encoding-type' not in group.attrs:
+            set_encoding(group, 'dict', '0.1.0')
+    return group
+
+def swap(group, tmp_name, name):
+    """Replace group[name] with the element staged at group[tmp_name]."""
+    if name in group:
+        del group[name]
+    group.move(tmp_name, name)
+
+def write_element(group, name, value):
+    """Write value as group[name] with the encoding attrs anndata uses for it."""
+    if isinstance(value, dict):
+        sub = group.create_group(name)
+        set_encoding(sub, 'dict', '0.1.0')
+        for key, item in value.items():
+            if item is not None:
+                write_element(sub, key, item)
+    elif isinstance(value, str):
+        dataset = group.create_dataset(name, data=value, dtype=h5py.string_dtype())
+        set_encoding(dataset, 'string', '0.2.0')
+    elif isinstance(value, (bool, int, float, np.generic)):
+        dataset = group.create_dataset(name, data=np.asarray(value))
+        set_encoding(dataset, 'numeric-scalar', '0.2.0')
+    else:
+        values = np.asarray(value)
+        if values.dtype.kind in ('U', 'O'):
+            dataset = group.create_dataset(name, data=values.astype(str).astype(object), dtype=h5py.string_dtype())
+            set_encoding(dataset, 'string-array', '0.2.0')
+        elif values.dtype.kind in ('b', 'i', 'u', 'f', 'c'):
+            dataset = group.create_dataset(name, data=values)
+            set_encoding(dataset, 'array', '0.2.0')
+        else:
+            raise Exception("Can't write {0} of type {1} to an H5AD".format(name, type(value).__name__))
+
+def set_encoding(node, encoding_type, encoding_version):
+    node.attrs['encoding-type'] = encoding_type
+    node.attrs['encoding-version'] = encoding_version
+
+def _n_rows(h5, group):
+    # obs/var are a group of columns keyed by _index, or a compound dataset in old files
+    node = h5[group]
+    if isinstance(node, h5py.Dataset):
+        return node.shape[0]
+    index_key = node.attrs.get('_index', 'index')
+    index_key = index_key.decode() if isinstance(index_key, bytes) else str(index_key)
+    return node[index_key].shape[0]
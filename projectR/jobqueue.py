@@ -0,0 +1,188 @@
+"""
+
+SQLite-backed queue of dimension-reduction jobs, shared by Calc_Dim_Reduction.cgi (which
+submits and polls) and dimreduction_worker.py (which runs them).
+
+A job is identified by its (dataset, analysis, user, session, params).  Submitting one
+that is already queued, running or done returns the existing job instead of adding
+another, so a user hammering the same button shares one computation.  A failed job is
+requeued by resubmitting it, and so is a done job whose dataset file has been modified
+since it finished.
+
+Each job carries an estimate of the memory it needs, and claim() only hands out jobs that
+fit in what the caller has left, so the worker can cap concurrency by memory rather than
+by a job count alone.
+
+    queue = jobqueue.JobQueue()
+    job = queue.submit(dataset_id, analysis_id, analysis_type, user_id, params, est_bytes,
+                       session_id=session_id, source_mtime=jobqueue.file_mtime(h5ad_path))
+    queue.status(job['id'])   # {'status': 'queued' | 'running' | 'done' | 'failed', ...}
+
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+# Default queue location.  Must be writable by both the web server and the worker.
+JOB_DB = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dimreduction_jobs.sqlite')
+
+STATUSES = ['queued', 'running', 'done', 'failed']
+# In-memory AnnData (sparse X plus PCA work arrays) relative to the H5AD's size on disk
+MEMORY_FACTOR = 3
+
+
+class JobQueue:
+    def __init__(self, db_path=JOB_DB):
+        self.db_path = db_path
+        self.cnx = sqlite3.connect(db_path, timeout=60, isolation_level=None, check_same_thread=False)
+        self.cnx.row_factory = sqlite3.Row
+        # The worker's job threads share this connection with its claiming loop
+        self.lock = threading.RLock()
+        self.cnx.execute("PRAGMA journal_mode=WAL")
+        self.cnx.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, job_key TEXT NOT NULL UNIQUE, "
+            "dataset_id TEXT NOT NULL, analysis_id TEXT, analysis_type TEXT, user_id INTEGER, session_id TEXT, "
+            "params TEXT NOT NULL, est_bytes INTEGER NOT NULL DEFAULT 0, status TEXT NOT NULL, "
+            "worker_pid INTEGER, result TEXT, error TEXT, "
+            "created REAL NOT NULL, started REAL, finished REAL)")
+        self.cnx.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+        # Queues created before jobs carried their session
+        if 'session_id' not in [row['name'] for row in self.cnx.execute("PRAGMA table_info(jobs)")]:
+            self.cnx.execute("ALTER TABLE jobs ADD COLUMN session_id TEXT")
+
+    def close(self):
+        self.cnx.close()
+
+    def submit(self, dataset_id, analysis_id, analysis_type, user_id, params, est_bytes=0,
+               session_id=None, source_mtime=None):
+        """
+        Input: The analysis to reduce, the user asking, the run_pca() params (a dict), an
+               estimate of the memory the job needs, the user's session (which decides
+               where unsaved analyses live) and the dataset file's mtime.
+
+        Output: The job as a dict.  An identical job that is queued, running or done is
+               returned as it is.  A failed one, or a done one whose dataset file changed
+               after it finished, is put back in the queue.
+        """
+        with self.lock:
+            params = json.dumps(params, sort_keys=True)
+            key = job_key(dataset_id, analysis_id, analysis_type, params, user_id, session_id)
+            self.cnx.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.cnx.execute("SELECT * FROM jobs WHERE job_key = ?", (key,)).fetchone()
+                if row is None:
+                    self.cnx.execute(
+                        "INSERT INTO jobs (job_key, dataset_id, analysis_id, analysis_type, user_id, session_id, params, est_bytes, status, created) "
+                        "VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'queued', ?)",
+                        (key, dataset_id, analysis_id, analysis_type, user_id, session_id, params, est_bytes, time.time()))
+                elif row['status'] == 'failed' or (row['status'] == 'done' and _stale(row, source_mtime)):
+                    self.cnx.execute(
+                        "UPDATE jobs SET status = 'queued', est_bytes = ?, result = NULL, error = NULL, worker_pid = NULL, "
+                        "created = ?, started = NULL, finished = NULL WHERE id = ?",
+                        (est_bytes, time.time(), row['id']))
+                self.cnx.execute("COMMIT")
+            except Exception:
+                self.cnx.execute("ROLLBACK")
+                raise
+            return self.status_by_key(key)
+
+    def status(self, job_id):
+        """The job as a dict (with params and result decoded), or None if there is no such job."""
+        with self.lock:
+            return _job_dict(self.cnx.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def status_by_key(self, key):
+        with self.lock:
+            return _job_dict(self.cnx.execute("SELECT * FROM jobs WHERE job_key = ?", (key,)).fetchone())
+
+    def claim(self, free_bytes):
+        """
+        Mark the oldest queued job whose memory estimate fits in free_bytes as running for
+        this process and return it, or return None if none fits.
+        """
+        with self.lock:
+            self.cnx.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.cnx.execute(
+                    "SELECT * FROM jobs WHERE status = 'queued' AND est_bytes <= ? ORDER BY id LIMIT 1",
+                    (free_bytes,)).fetchone()
+                if row is not None:
+                    self.cnx.execute("UPDATE jobs SET status = 'running', worker_pid = ?, started = ? WHERE id = ?",
+                                     (os.getpid(), time.time(), row['id']))
+                self.cnx.execute("COMMIT")
+            except Exception:
+                self.cnx.execute("ROLLBACK")
+                raise
+            return self.status(row['id']) if row is not None else None
+
+    def finish(self, job_id, result):
+        with self.lock:
+            self.cnx.execute("UPDATE jobs SET status = 'done', result = ?, error = NULL, finished = ? WHERE id = ?",
+                             (json.dumps(result), time.time(), job_id))
+
+    def fail(self, job_id, error):
+        with self.lock:
+            self.cnx.execute("UPDATE jobs SET status = 'failed', error = ?, finished = ? WHERE id = ?",
+                             (str(error), time.time(), job_id))
+
+    def requeue_orphans(self):
+        """
+        Put jobs left 'running' by a worker that is no longer alive back in the queue.
+        Returns how many were requeued.
+        """
+        with self.lock:
+            orphans = [row['id'] for row in self.cnx.execute("SELECT id, worker_pid FROM jobs WHERE status = 'running'")
+                       if not _pid_alive(row['worker_pid'])]
+            for job_id in orphans:
+                self.cnx.execute("UPDATE jobs SET status = 'queued', worker_pid = NULL, started = NULL WHERE id = ? AND status = 'running'",
+                                 (job_id,))
+            return len(orphans)
+
+def estimate_bytes(h5ad_path):
+    """Rough memory a job on this H5AD needs, from the file's size."""
+    if not h5ad_path or not os.path.isfile(h5ad_path):
+        return 0
+    return os.path.getsize(h5ad_path) * MEMORY_FACTOR
+
+def file_mtime(path):
+    """A file's mtime, or None if there is no such file."""
+    if not path or not os.path.isfile(path):
+        return None
+    return os.path.getmtime(path)
+
+def job_key(dataset_id, analysis_id, analysis_type, params, user_id=None, session_id=None):
+    """
+    Identity of a job: a hash of the dataset, analysis, (JSON-encoded, sorted) params and
+    the user and session asking.
+    """
+    fields = [dataset_id, analysis_id, analysis_type, params, user_id, session_id]
+    return hashlib.sha1("\t".join(str(field) for field in fields).encode()).hexdigest()
+
+def _stale(row, source_mtime):
+    # The worker writes its results before marking the job done, so only a later change counts
+    return source_mtime is not None and row['finished'] is not None and source_mtime > row['finished']
+
+def _job_dict(row):
+    if row is None:
+        return None
+    job = dict(row)
+    job['params'] = json.loads(job['params'])
+    if job['result'] is not None:
+        job['result'] = json.loads(job['result'])
+    return job
+
+def _pid_alive(pid):
+    if not pid:
+        return False
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
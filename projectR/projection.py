@@ -0,0 +1,229 @@
+#!/opt/bin/python3
+
+"""
+
+Python port of projectR_for_NeMO_Analytics.R: project a test dataset onto the gene
+loadings (uns['DimReductionGene'], as written by Calc_Dim_Reduction.cgi) of a reference
+dataset.
+
+The test matrix is read as CSR straight from the H5AD and is never densified.  Genes are
+aligned to the reference with an indexed join, the loadings are scattered into a
+(test genes x PCs) block, and the projection is one sparse x dense product followed by
+the small PC x PC least-squares solve projectR's lmFit does.
+
+The test matrix is streamed in blocks of cells (--block_size): each block's slice of
+X/data, X/indices and X/indptr is read with h5py, projected, and written into its rows of
+the result before the next block is read.  Peak memory scales with the block size, not
+the dataset, so atlases with millions of cells project in a fixed footprint.
+
+The result (cells x PCs) is stored in the test file at uns['projection'][<ref name>],
+which is the layout the R script used.  It is filled in under a temporary name and only
+renamed into place once every block is written.
+
+Several references can be given at once (-r A B C, as paths or, with --ref_dir, as
+dataset IDs).  The test matrix is then read a single time and projected onto all of them
+together; see project_h5ad_batch().
+
+With --cache_dir, the reference's loadings and genes come from a memory-mapped cache
+(refcache.py) instead of being read out of the reference H5AD on every run.
+
+Test command:
+
+./projection.py -r /path/to/K34_tsne.h5ad -t /path/to/CS22_PFC_tsne.h5ad -n K34_tsne -c /path/to/ref_cache
+./projection.py -d /path/to/datasets -r K34_tsne CS22_PFC_tsne -t /path/to/test.h5ad
+
+From Python (e.g. the CGI):
+
+    import projection
+    projection.project_h5ad(test_path, ref_path, 'K34_tsne')
+    projection.project_h5ad_batch(test_path, [('K34_tsne', ref_path), ('CS22', other_path)])
+
+"""
+
+import argparse
+import os
+
+import h5py
+import numpy as np
+import scipy.sparse
+
+import h5adpartial
+import refcache
+from genematch import align_loadings, attr_str, read_var_column
+
+# Cells per block when streaming the test matrix
+BLOCK_SIZE = 100000
+
+
+def main():
+    parser = argparse.ArgumentParser( description='Project a test H5AD onto the PCs of one or more reference H5ADs')
+    parser.add_argument('-r', '--reference', type=str, nargs='+', required=True, help='Reference H5AD(s) with uns/DimReductionGene: paths, or dataset IDs if --ref_dir is given')
+    parser.add_argument('-d', '--ref_dir', type=str, help='Directory holding <dataset ID>.h5ad reference files')
+    parser.add_argument('-t', '--test', type=str, required=True, help='Path to the test H5AD.  The projections are written into it')
+    parser.add_argument('-n', '--name', type=str, help='Name to store the projection under in uns/projection when there is one reference.  Defaults to the reference file name')
+    parser.add_argument('--test_gene_column', type=str, default='gene_symbol', help='var column of the test dataset to match on (default: gene_symbol, falling back to the var index)')
+    parser.add_argument('--ref_gene_column', type=str, help='var column of the reference dataset to match on (default: the var index)')
+    parser.add_argument('-b', '--block_size', type=int, default=BLOCK_SIZE, help='Number of cells read and projected at a time (default: {0})'.format(BLOCK_SIZE))
+    parser.add_argument('-c', '--cache_dir', type=str, help='Directory of cached reference models (see refcache.py).  The reference is read directly if not given')
+    args = parser.parse_args()
+
+    if args.name and len(args.reference) > 1:
+        raise Exception("--name can only be given with a single reference")
+
+    references = list()
+    for reference in args.reference:
+        ref_path = os.path.join(args.ref_dir, "{0}.h5ad".format(reference)) if args.ref_dir else reference
+        name = args.name or os.path.basename(ref_path).replace('.h5ad', '')
+        references.append((name, ref_path))
+
+    ref_cache = refcache.ReferenceCache(args.cache_dir) if args.cache_dir else None
+    project_h5ad_batch(args.test, references, test_gene_column=args.test_gene_column,
+                       ref_gene_column=args.ref_gene_column, block_size=args.block_size, ref_cache=ref_cache)
+
+
+def project_h5ad(test_path, ref_path, ref_name, test_gene_column='gene_symbol', ref_gene_column=None,
+                 block_size=BLOCK_SIZE, ref_cache=None):
+    """
+    Input: Paths to the test and reference H5ADs, the name to store the result under, how
+           many cells to project at a time and, optionally, a refcache.ReferenceCache to
+           take the reference's loadings and genes from.
+
+    Output: Nothing returned.  The cells x PCs projection is written to the test file at
+           uns/projection/<ref_name>.
+    """
+    project_h5ad_batch(test_path, [(ref_name, ref_path)], test_gene_column=test_gene_column,
+                       ref_gene_column=ref_gene_column, block_size=block_size, ref_cache=ref_cache)
+
+def project_h5ad_batch(test_path, references, test_gene_column='gene_symbol', ref_gene_column=None,
+                       block_size=BLOCK_SIZE, ref_cache=None):
+    """
+    Input: Path to the test H5AD, a list of (name, reference path) pairs and the same
+           options as project_h5ad().
+
+    Output: Nothing returned.  Each reference's projection is written to the test file at
+           uns/projection/<name>.
+
+    The test matrix is read once.  Every reference's aligned loadings are stacked side by
+    side, so each block of cells takes a single sparse x dense product for all of them;
+    the product's columns are then split up and each reference's (L'L)^-1 applied.  All
+    results are written in this one open of the test file and renamed into place together
+    at the end.
+    """
+    if not references:
+        raise Exception("No references to project onto")
+    names = [name for name, _ in references]
+    if len(set(names)) != len(names):
+        raise Exception("Reference names must be unique: {0}".format(", ".join(names)))
+
+    if ref_cache:
+        # Cached under the reference's dataset ID (its file name), not the projection's label
+        models = [ref_cache.get(ref_path) for _, ref_path in references]
+    else:
+        models = [read_reference(ref_path, ref_gene_column) for _, ref_path in references]
+
+    with h5py.File(test_path, 'r+') as h5:
+        test_genes = read_var_column(h5, test_gene_column)
+        aligned = list()
+        for model in models:
+            if ref_cache:
+                aligned.append(model.align(test_genes, ref_gene_column))
+            else:
+                aligned.append(align_loadings(test_genes, model[1], model[0]))
+        solves = [projection_operator(a) for a in aligned]
+        stacked = np.hstack(aligned)
+        bounds = np.cumsum([0] + [a.shape[1] for a in aligned])
+
+        n_cells = matrix_shape(h5)[0]
+        group = h5adpartial.require_group(h5, 'uns/projection')
+        results = list()
+        for name, a in zip(names, aligned):
+            tmp_name = ".{0}.partial".format(name)
+            if tmp_name in group:
+                del group[tmp_name]
+            # h5py won't chunk an empty dataset, so a test file without cells gets an empty projection
+            chunks = (min(n_cells, block_size), a.shape[1]) if n_cells else None
+            results.append(group.create_dataset(tmp_name, shape=(n_cells, a.shape[1]), dtype=np.float64, chunks=chunks))
+
+        for start, block in iter_row_blocks(h5, block_size):
+            product = np.asarray(block @ stacked)
+            for i, result in enumerate(results):
+                result[start:start + block.shape[0]] = product[:, bounds[i]:bounds[i + 1]] @ solves[i]
+
+        for name, result in zip(names, results):
+            h5adpartial.set_encoding(result, 'array', '0.2.0')
+            h5adpartial.swap(group, ".{0}.partial".format(name), name)
+
+def read_reference(ref_path, gene_column=None):
+    """
+    Output: (loadings, genes) of a reference H5AD.  loadings is genes x PCs, from
+           uns/DimReductionGene (the PCs varm written by Calc_Dim_Reduction.cgi).
+    """
+    with h5py.File(ref_path, 'r') as h5:
+        loadings = h5['uns/DimReductionGene'][()]
+        genes = read_var_column(h5, gene_column)
+    if loadings.shape[0] != len(genes):
+        raise Exception("Reference {0} has {1} genes but {2} rows of loadings".format(ref_path, len(genes), loadings.shape[0]))
+    return loadings, genes
+
+def matrix_shape(h5, key='X'):
+    """(cells, genes) of the matrix stored at key."""
+    node = h5[key]
+    if isinstance(node, h5py.Dataset):
+        return node.shape
+    return tuple(node.attrs.get('shape', node.attrs.get('h5sparse_shape')))
+
+def iter_row_blocks(h5, block_size, key='X'):
+    """
+    Input: An open H5AD, the number of cells per block and the matrix key.
+
+    Output: Yields (first row, CSR block) pairs covering the matrix in order.  Only one
+           block's worth of data/indices (or dense rows) is read from the file at a time.
+    """
+    node = h5[key]
+    n_rows, n_cols = matrix_shape(h5, key)
+
+    if isinstance(node, h5py.Dataset):
+        # Old H5ADs store small matrices dense
+        for start in range(0, n_rows, block_size):
+            yield start, scipy.sparse.csr_matrix(node[start:start + block_size])
+        return
+
+    encoding = attr_str(node.attrs.get('encoding-type', node.attrs.get('h5sparse_format', 'csr')))
+    if encoding.startswith('csc'):
+        # Rows of a CSC matrix are spread across the whole file, so there is no cheap row block
+        matrix = scipy.sparse.csc_matrix((node['data'][()], node['indices'][()], node['indptr'][()]),
+                                         shape=(n_rows, n_cols)).tocsr()
+        for start in range(0, n_rows, block_size):
+            yield start, matrix[start:start + block_size]
+        return
+
+    indptr = node['indptr']
+    for start in range(0, n_rows, block_size):
+        end = min(start + block_size, n_rows)
+        block_indptr = indptr[start:end + 1]
+        lo, hi = int(block_indptr[0]), int(block_indptr[-1])
+        yield start, scipy.sparse.csr_matrix(
+            (node['data'][lo:hi], node['indices'][lo:hi], block_indptr - lo), shape=(end - start, n_cols))
+
+def projection_operator(aligned_loadings):
+    """
+    (L'L)^-1 for loadings aligned to the test genes.  Computed once and applied to every
+    block of cells.
+    """
+    return np.linalg.pinv(aligned_loadings.T @ aligned_loadings)
+
+def project(X, aligned_loadings, solve=None):
+    """
+    Input: A test matrix or block of cells (cells x genes, sparse), loadings aligned to its
+           genes and, optionally, their projection_operator().
+
+    Output: cells x PCs least-squares coefficients, the same as projectR's lmFit of each
+           cell's expression on the loadings: (L'L)^-1 L'x.
+    """
+    if solve is None:
+        solve = projection_operator(aligned_loadings)
+    return np.asarray(X @ aligned_loadings) @ solve
+
+
+if __name__ == '__main__':
+    main()
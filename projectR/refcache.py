@@ -0,0 +1,149 @@
+"""
+
+On-disk cache of reference models (PC loadings + gene identifiers) for projection.py.
+
+Reading uns/DimReductionGene and var out of a reference H5AD costs seconds every time,
+while users project many test datasets onto the same few references.  The first request
+for a reference writes its loadings and genes out as .npy files; every later request (in
+any process) memory-maps them, so concurrent projections share the same pages from the
+OS page cache instead of each holding a private copy.
+
+Entries are keyed on the reference's dataset ID plus the H5AD's mtime, so recomputing a
+reference's PCs invalidates its entry automatically.  Old entries for the same dataset
+are removed when a new one is built.
+
+    cache = refcache.ReferenceCache('/path/to/cache_dir')
+    model = cache.get('/path/to/K34_tsne.h5ad')
+    model.loadings              # genes x PCs, read-only memmap
+    model.genes('gene_symbol')  # pandas Index (hash-indexed) of the reference genes
+    model.genes()               # ... and of the var index (Ensembl IDs for NeMO datasets)
+
+"""
+
+import collections
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import threading
+
+import h5py
+import numpy as np
+import pandas as pd
+
+import genematch
+
+# var columns indexed alongside the var index
+GENE_COLUMNS = ['gene_symbol']
+# Gene alignments remembered per reference model
+MAX_ALIGNMENTS = 16
+
+class ReferenceModel:
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as fh:
+            self.meta = json.load(fh)
+        self.loadings = np.load(os.path.join(path, 'loadings.npy'), mmap_mode='r')
+        self._genes = dict()
+        self._alignments = collections.OrderedDict()
+
+    def genes(self, column=None):
+        """
+        Reference genes for a var column (None for the var index) as a pandas Index.  The
+        Index's hash table is built on first use and kept for this model's lifetime.
+        """
+        column = column if column in self.meta['columns'] else None
+        key = column or 'index'
+        if key not in self._genes:
+            values = np.load(os.path.join(self.path, 'genes.{0}.npy'.format(key)), mmap_mode='r')
+            index = pd.Index(values.astype(object))
+            index.get_indexer(index[:1])   # build the hash table now rather than mid-request
+            self._genes[key] = index
+        return self._genes[key]
+
+    def align(self, test_genes, column=None):
+        """
+        Input: The test dataset's genes and the reference var column to match them on.
+
+        Output: genematch.align_loadings() for these genes.  Datasets from the same
+               pipeline share gene lists, so recent alignments are kept and reused.
+        """
+        digest = hashlib.sha1(str(column).encode())
+        for gene in test_genes:
+            digest.update(b"\n" + str(gene).encode())
+        key = digest.hexdigest()
+        if key in self._alignments:
+            self._alignments.move_to_end(key)
+            return self._alignments[key]
+
+        aligned = genematch.align_loadings(test_genes, self.genes(column), self.loadings)
+        self._alignments[key] = aligned
+        if len(self._alignments) > MAX_ALIGNMENTS:
+            self._alignments.popitem(last=False)
+        return aligned
+
+class ReferenceCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        os.makedirs(cache_dir, exist_ok=True)
+        self.models = dict()
+        self.lock = threading.Lock()
+
+    def get(self, ref_path, ref_id=None):
+        """
+        Input: Path to a reference H5AD and its dataset ID (defaults to the file name
+               without .h5ad).
+
+        Output: A ReferenceModel for the file as it is now, built if not already cached.
+        """
+        ref_id = ref_id or os.path.basename(ref_path).replace('.h5ad', '')
+        entry = "{0}.{1}".format(ref_id, os.stat(ref_path).st_mtime_ns)
+        entry_path = os.path.join(self.cache_dir, entry)
+
+        with self.lock:
+            if entry in self.models:
+                return self.models[entry]
+            if not os.path.isfile(os.path.join(entry_path, 'meta.json')):
+                self._build(ref_path, ref_id, entry_path)
+            model = ReferenceModel(entry_path)
+            self.models[entry] = model
+            return model
+
+    def _build(self, ref_path, ref_id, entry_path):
+        # Build in a private directory and rename it into place, so a concurrent reader
+        # either sees a complete entry or none at all
+        tmp_path = tempfile.mkdtemp(prefix=".{0}.".format(ref_id), dir=self.cache_dir)
+        columns = list()
+        with h5py.File(ref_path, 'r') as h5:
+            loadings = h5['uns/DimReductionGene'][()]
+            genes = genematch.read_var_column(h5)
+            if loadings.shape[0] != len(genes):
+                shutil.rmtree(tmp_path, ignore_errors=True)
+                raise Exception("Reference {0} has {1} genes but {2} rows of loadings".format(ref_path, len(genes), loadings.shape[0]))
+            np.save(os.path.join(tmp_path, 'loadings.npy'), loadings)
+            np.save(os.path.join(tmp_path, 'genes.index.npy'), genes.values.astype(str))
+            # NeMO datasets are indexed on Ensembl IDs with the symbols kept alongside
+            for column in GENE_COLUMNS:
+                if column in genematch.var_columns(h5):
+                    np.save(os.path.join(tmp_path, 'genes.{0}.npy'.format(column)),
+                            genematch.read_var_column(h5, column).values.astype(str))
+                    columns.append(column)
+        with open(os.path.join(tmp_path, 'meta.json'), 'w') as fh:
+            json.dump({'ref_path': os.path.abspath(ref_path), 'ref_id': ref_id, 'columns': columns,
+                       'shape': list(loadings.shape)}, fh)
+
+        try:
+            os.rename(tmp_path, entry_path)
+        except OSError:
+            # Another process built the same entry first
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+        # Drop entries for older versions of this reference: exactly <ref_id>.<mtime_ns>,
+        # so references whose IDs merely start with this one are left alone
+        stale_entry = re.compile(r"{0}\.\d+".format(re.escape(ref_id)))
+        for name in os.listdir(self.cache_dir):
+            stale = os.path.join(self.cache_dir, name)
+            if stale_entry.fullmatch(name) and stale != entry_path:
+                shutil.rmtree(stale, ignore_errors=True)
@@ -0,0 +1,209 @@
+"""
+Classifies dataset tarballs and indexes their members without reading more than it has to.
+
+    index = archiveinspector.inspect('/path/to/bundle.mex.tar.gz')
+    index.bundle_type      # 'mex', '3tab', 'h5ad' or None
+    index.members          # [MemberEntry(name, offset_data, size), ...]
+
+inspect() walks the tar headers only until the bundle type is settled (an H5AD member, or
+every member a MEX or 3tab bundle needs) and then stops, so classifying a multi-GB .tar.gz
+usually costs a few KB of inflation.  An index
+built from a full walk (inspect(path, full=True), or remember() with the members some
+other pass already read) is cached in memory and, if a cache_dir is given, on disk keyed
+by path, size and mtime.  Later steps use it to seek straight to a member's data in an
+uncompressed tar without re-scanning the headers:
+
+    with index.open(entry) as fh:
+        ...
+
+"""
+
+import collections
+import hashlib
+import io
+import json
+import os
+import tarfile
+
+from tarstreamer import member_role
+
+MemberEntry = collections.namedtuple('MemberEntry', ['name', 'offset_data', 'size'])
+
+# Member roles (see tarstreamer.member_role) a bundle needs before it counts as that type
+REQUIRED_ROLES = {
+    'mex': {'matrix', 'barcodes', 'genes'},
+    '3tab': {'data', 'obs', 'var'},
+}
+
+# Indexes built in this process, keyed on (path, size, mtime)
+_indexes = dict()
+
+
+class ArchiveIndex:
+    def __init__(self, path, compressed, members, complete, bundle_type):
+        self.path = path
+        self.compressed = compressed
+        self.members = members
+        # False if the walk stopped early and members only holds the first few headers
+        self.complete = complete
+        self.bundle_type = bundle_type
+
+    def find(self, role):
+        """Return the first member with the given tarstreamer role ('matrix', 'obs', ...), or None."""
+        for entry in self.members:
+            if member_role(entry.name)[1] == role:
+                return entry
+        return None
+
+    def seekable(self):
+        """True if members can be read by seeking straight to their data."""
+        return self.complete and not self.compressed
+
+    def open(self, entry):
+        """
+        Readable binary stream over one member's data, found by seeking to its recorded
+        offset.  Only possible when seekable().
+        """
+        if not self.seekable():
+            raise Exception("Members of {0} can't be opened by offset".format(self.path))
+        raw = open(self.path, 'rb')
+        raw.seek(entry.offset_data)
+        return io.BufferedReader(_RangeReader(raw, entry.size))
+
+    def to_dict(self):
+        return {'path': self.path, 'compressed': self.compressed, 'complete': self.complete,
+                'bundle_type': self.bundle_type, 'members': [list(m) for m in self.members]}
+
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['path'], d['compressed'], [MemberEntry(*m) for m in d['members']],
+                   d['complete'], d['bundle_type'])
+
+def inspect(path, full=False, cache_dir=None):
+    """
+    Input: Path to a .tar or .tar.gz bundle.  With full=True every header is read so the
+           index is complete; otherwise reading stops as soon as the type is known.
+
+    bundle_type is only set once all of a type's REQUIRED_ROLES have turned up, so a bundle
+    missing one of its files is left as None.
+
+    Output: An ArchiveIndex.  A cached complete index is returned without opening the tar.
+    """
+    index = cached(path, cache_dir)
+    if index:
+        # May only have been in memory so far
+        _store(index, cache_dir)
+        return index
+
+    members = list()
+    roles = collections.defaultdict(set)
+    bundle_type = None
+    complete = True
+    with open(path, 'rb') as raw:
+        compressed = _is_compressed(raw)
+        with tarfile.open(fileobj=raw, mode='r:*') as tf:
+            while True:
+                member = tf.next()
+                if member is None:
+                    break
+                if not member.isfile():
+                    continue
+                members.append(MemberEntry(member.name, member.offset_data, member.size))
+                bundle_type = bundle_type or _settled_type(member.name, roles)
+                if bundle_type and not full:
+                    complete = False
+                    break
+
+    index = ArchiveIndex(path, compressed, members, complete, bundle_type)
+    if complete:
+        _store(index, cache_dir)
+    return index
+
+def remember(path, tarinfos, cache_dir=None):
+    """
+    Record the complete index of a tarball from TarInfos some other pass already walked
+    (e.g. while extracting), so later steps don't have to walk it again.  Returns the index.
+    """
+    with open(path, 'rb') as raw:
+        compressed = _is_compressed(raw)
+    members = [MemberEntry(t.name, t.offset_data, t.size) for t in tarinfos if t.isfile()]
+    roles = collections.defaultdict(set)
+    bundle_type = None
+    for entry in members:
+        bundle_type = bundle_type or _settled_type(entry.name, roles)
+    index = ArchiveIndex(path, compressed, members, True, bundle_type)
+    _store(index, cache_dir)
+    return index
+
+def cached(path, cache_dir=None):
+    """Return the cached complete index for this exact version of the file, or None."""
+    key = _key(path)
+    if key in _indexes:
+        return _indexes[key]
+    if cache_dir:
+        cache_path = _cache_path(key, cache_dir)
+        if os.path.isfile(cache_path):
+            with open(cache_path) as fh:
+                index = ArchiveIndex.from_dict(json.load(fh))
+            _indexes[key] = index
+            return index
+    return None
+
+def _settled_type(name, roles):
+    """
+    Note the role of one more member in roles ({bundle type: roles seen so far}) and return
+    the bundle type if that settles it, otherwise None.
+    """
+    bundle_type, role = member_role(name)
+    if role:
+        roles[bundle_type].add(role)
+        return bundle_type if roles[bundle_type] >= REQUIRED_ROLES[bundle_type] else None
+    if name.endswith('.h5ad'):
+        return 'h5ad'
+    return None
+
+class _RangeReader(io.RawIOBase):
+    def __init__(self, fh, size):
+        self.fh = fh
+        self.remaining = size
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        if self.remaining <= 0:
+            return 0
+        data = self.fh.read(min(len(buffer), self.remaining))
+        buffer[:len(data)] = data
+        self.remaining -= len(data)
+        return len(data)
+
+    def close(self):
+        self.fh.close()
+        super().close()
+
+def _is_compressed(raw):
+    magic = raw.read(2)
+    raw.seek(0)
+    return magic == b'\x1f\x8b'
+
+def _key(path):
+    st = os.stat(path)
+    return (os.path.abspath(path), st.st_size, int(st.st_mtime))
+
+def _cache_path(key, cache_dir):
+    digest = hashlib.sha1("{0}\t{1}\t{2}".format(*key).encode()).hexdigest()
+    return os.path.join(cache_dir, "{0}.json".format(digest))
+
+def _store(index, cache_dir):
+    key = _key(index.path)
+    _indexes[key] = index
+    if cache_dir:
+        os.makedirs(cache_dir, exist_ok=True)
+        cache_path = _cache_path(key, cache_dir)
+        if os.path.isfile(cache_path):
+            return
+        tmp_path = "{0}.{1}.tmp".format(cache_path, os.getpid())
+        with open(tmp_path, 'w') as fh:
+            json.dump(index.to_dict(), fh)
+        os.replace(tmp_path, cache_path)
@@ -1,5 +1,6 @@
-import os, sys
-import tarfile
+import sys
+
+import archiveinspector
 
 class FileType(object):
     # filetypes = []
@@ -58,8 +59,8 @@ class DatasetUploader:
         """
         Since we allow users to upload tarballs (.tar or .tar.gz) we don't know
         from the filename alone if this is MEX or ThreeTab.  This method reads the contents
-        of the tarball and returns either 'mex' or 'threetab' based on what it finds. The basenames variable
-	contains the filenames in case the files are within a forlder inside the tarball.
+        of the tarball and returns either 'mex' or 'threetab' based on what it finds. Member names
+        are matched on their basename in case the files are within a folder inside the tarball.
 
         mex:
         matrix.mtx
@@ -72,19 +73,14 @@ class DatasetUploader:
         observations.tab
 
         None is returned if neither of these is true
+
+        Only the first few headers are read: the walk stops once all three files of one
+        type have been seen (see archiveinspector.inspect), rather than listing every
+        member of the archive.
         """
-        t = tarfile.open(file, 'r')
-        filenames = t.getnames()
-        basenames=[]
-        for f_path in filenames:
-            fname=os.path.basename(f_path)
-            basenames.append(fname)
- #       if 'expression.tab' in filenames and 'genes.tab' in filenames and 'observations.tab' in filenames:
- #           return 'threetab'
- #       if 'matrix.mtx' in filenames and 'barcodes.tsv' in filenames and 'genes.tsv' in filenames:
- #           return 'mex'
-        if 'expression.tab' in basenames and 'genes.tab' in basenames and 'observations.tab' in basenames:
+        index = archiveinspector.inspect(file)
+        if index.bundle_type == '3tab':
             return 'threetab'
-        if 'matrix.mtx' in basenames and 'barcodes.tsv' in basenames and 'genes.tsv' in basenames:
-            return 'mex'        
+        if index.bundle_type == 'mex':
+            return 'mex'
         return None
@@ -0,0 +1,119 @@
+"""
+Reads a MatrixMarket coordinate file (a MEX bundle's matrix.mtx) straight into a cells x
+genes CSR matrix.
+
+scipy.io.mmread parses the file into a genes x cells COO matrix, and flipping that to
+cells x genes CSR makes a second full copy.  Here the entries are parsed in large chunks
+by pandas' C parser into preallocated index and value arrays, and the CSR arrays are
+built from them in the final orientation: cell counts give indptr directly, and since 10x
+writes entries ordered by cell, the entries usually need no reordering at all.
+
+Value and index arrays use the narrowest dtype that holds them: counts stored as
+'integer' (or as 'real' but all whole numbers) become the smallest unsigned integer type
+that fits, and real values become float32 when that loses nothing.
+
+    with gzip.open('matrix.mtx.gz', 'rb') as fh:
+        X = mexparser.read_mtx(fh)
+
+"""
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+# Entries parsed per chunk
+CHUNK_SIZE = 10000000
+
+
+def read_mtx(fh, chunk_size=CHUNK_SIZE):
+    """
+    Input: A binary file object positioned at the start of a MatrixMarket coordinate file
+           (genes x cells, as 10x and NeMO write them).
+
+    Output: A scipy CSR matrix of cells x genes with sorted indices.
+    """
+    field, n_genes, n_cells, nnz = _read_header(fh)
+
+    cells = np.empty(nnz, dtype=_index_dtype(n_cells))
+    genes = np.empty(nnz, dtype=_index_dtype(n_genes))
+    value_dtype = np.float64 if field == 'real' else np.int64
+    values = np.ones(nnz, dtype=np.uint8) if field == 'pattern' else np.empty(nnz, dtype=value_dtype)
+
+    usecols = [0, 1] if field == 'pattern' else [0, 1, 2]
+    dtypes = {0: np.int64, 1: np.int64, 2: value_dtype}
+    filled = 0
+    reader = pd.read_csv(fh, sep=r'\s+', header=None, usecols=usecols, dtype=dtypes,
+                         chunksize=chunk_size, engine='c', comment='%')
+    for chunk in reader:
+        end = filled + len(chunk)
+        if end > nnz:
+            raise Exception("MatrixMarket file has more entries than the {0} its header declares".format(nnz))
+        # MatrixMarket indexes are 1-based
+        genes[filled:end] = chunk[0].values - 1
+        cells[filled:end] = chunk[1].values - 1
+        if field != 'pattern':
+            values[filled:end] = chunk[2].values
+        filled = end
+    if filled != nnz:
+        raise Exception("MatrixMarket file has {0} entries but its header declares {1}".format(filled, nnz))
+
+    if field != 'pattern':
+        values = narrow_values(values)
+
+    # Row pointers straight from the number of entries per cell
+    index_dtype = np.int32 if max(nnz, n_genes, n_cells) < np.iinfo(np.int32).max else np.int64
+    indptr = np.zeros(n_cells + 1, dtype=index_dtype)
+    np.cumsum(np.bincount(cells, minlength=n_cells), out=indptr[1:])
+
+    if nnz and not (cells[1:] >= cells[:-1]).all():
+        order = np.argsort(cells, kind='stable')
+        genes = genes[order]
+        values = values[order]
+    del cells
+
+    X = scipy.sparse.csr_matrix((values, genes.astype(index_dtype, copy=False), indptr),
+                                shape=(n_cells, n_genes))
+    if not X.has_sorted_indices:
+        X.sort_indices()
+    return X
+
+def narrow_values(values):
+    """Return the values in the narrowest integer or float dtype that holds them exactly."""
+    if not len(values):
+        return values.astype(np.float32)
+    if values.dtype.kind == 'f':
+        if not np.all(np.isfinite(values)) or not np.array_equal(values, np.round(values)):
+            narrowed = values.astype(np.float32)
+            return narrowed if np.array_equal(narrowed, values) else values
+    lo, hi = values.min(), values.max()
+    for dtype in (np.uint8, np.uint16, np.uint32, np.int8, np.int16, np.int32, np.int64):
+        info = np.iinfo(dtype)
+        if info.min <= lo and hi <= info.max:
+            return values.astype(dtype)
+    return values
+
+def _read_header(fh):
+    banner = _decode(fh.readline()).split()
+    if len(banner) != 5 or banner[0].lower() != '%%matrixmarket':
+        raise Exception("Not a MatrixMarket file")
+    layout, field, symmetry = banner[2].lower(), banner[3].lower(), banner[4].lower()
+    if layout != 'coordinate':
+        raise Exception("Only MatrixMarket coordinate files are supported, not {0}".format(layout))
+    if field not in ('integer', 'real', 'pattern'):
+        raise Exception("Unsupported MatrixMarket field type {0}".format(field))
+    if symmetry != 'general':
+        raise Exception("Unsupported MatrixMarket symmetry {0}".format(symmetry))
+
+    line = _decode(fh.readline())
+    while line.startswith('%') or not line.strip():
+        line = _decode(fh.readline())
+        if line == '':
+            raise Exception("MatrixMarket file has no size line")
+    n_genes, n_cells, nnz = (int(x) for x in line.split())
+    return field, n_genes, n_cells, nnz
+
+def _decode(line):
+    return line.decode() if isinstance(line, bytes) else line
+
+def _index_dtype(size):
+    return np.int32 if size < np.iinfo(np.int32).max else np.int64
@@ -1,11 +1,11 @@
 import anndata
-import pandas as pd
 import numpy as np
-import os, sys
+import sys
 import scanpy.api as sc
 sc.settings.verbosity = 0
 
 from datasetuploader import FileType
+import tarstreamer
 
 
 class MexUploader(FileType):
@@ -43,32 +43,8 @@ class MexUploader(FileType):
             'filepath' is the file path of the original file
 
         """
-        import tarfile
-
-        #Get tar filename so tmp directory can be assigned
-        tar_filename = filepath.rsplit('/', 1)[1].rsplit('.')[0]
-        tmp_dir = 'tmp/' + tar_filename
-
-        # Open the archive and extract each file into the tmp directory
-        with tarfile.open(filepath) as tf:
-            for entry in tf:
-
-                # Extract file into tmp dir
-                filepath = "{0}/{1}".format(tmp_dir, entry.name)
-                tf.extract(entry, path=tmp_dir)
-
-                # Read each file (.mtx as adata.X and .tsv as pandas dataframes) 
-                # Check if file is in a folder within the filepath
-                if entry.name == 'matrix.mtx' or os.path.basename(filepath)== 'matrix.mtx':
-                    adata = sc.read(filepath, cache=False).transpose()
-                elif entry.name == 'barcodes.tsv' or os.path.basename(filepath)== 'barcodes.tsv':
-                    obs = pd.read_csv(filepath, sep='\t', index_col=0, header=None, names=['observations'])
-                elif entry.name == 'genes.tsv' or os.path.basename(filepath)=='genes.tsv':
-                    var = pd.read_csv(filepath, sep='\t', index_col=0, header=None, names=['genes', 'gene_symbol'])
-
-        # Assign genes and observations to AnnData object
-        adata.var = var
-        adata.obs = obs
+        # Members are parsed straight out of the tar stream.  Nothing is extracted to disk.
+        adata = tarstreamer.read_mex(filepath)
 
         # Apply AnnData obj and filepath to uploader obj
         self.adata = adata
@@ -0,0 +1,184 @@
+"""
+Gzip decompression that uses more than one core.
+
+  * BGZF files (gzip written as a series of independent blocks of at most 64 KB, with
+    each block's size in its header, as bgzip and htslib write them) are inflated block
+    parallel: blocks are read sequentially and handed to a pool of threads, since zlib
+    releases the GIL while it works.
+  * Ordinary gzip is one deflate stream and has to be inflated in order, but it is done
+    on a read-ahead thread, so inflating overlaps with whatever the reader does with the
+    data (parsing a tar stream, a MatrixMarket file...).
+
+open_stream() returns a readable binary stream for a path or an open file, whatever the
+compression (uncompressed input is passed through), so it drops into tarfile's streaming
+mode as well as the member readers:
+
+    with tarfile.open(fileobj=parallelgzip.open_stream(path), mode='r|') as tf:
+        ...
+
+"""
+
+import collections
+import concurrent.futures
+import gzip
+import io
+import os
+import queue
+import shutil
+import struct
+import threading
+import zlib
+
+WORKERS = min(8, os.cpu_count() or 1)
+READ_SIZE = 4 * 1024 * 1024
+# Inflated chunks the read-ahead thread may get in front of the reader
+READAHEAD = 8
+
+GZIP_MAGIC = b'\x1f\x8b'
+
+
+def open_stream(source, workers=None):
+    """
+    Input: A path or a readable binary file object, and optionally the number of threads
+           to inflate BGZF blocks on.
+
+    Output: A readable binary stream of the decompressed data (or of the data as is, if
+           it isn't gzipped).  Closing it closes the source.
+    """
+    raw = open(source, 'rb') if isinstance(source, str) else source
+    fh = raw if hasattr(raw, 'peek') else io.BufferedReader(raw)
+    magic = fh.peek(18)[:18]
+    if is_bgzf(magic):
+        return io.BufferedReader(_BgzfReader(fh, workers or WORKERS), buffer_size=READ_SIZE)
+    if magic[:2] == GZIP_MAGIC:
+        return io.BufferedReader(_ReadaheadReader(gzip.GzipFile(fileobj=fh, mode='rb'), fh), buffer_size=READ_SIZE)
+    return fh
+
+def is_bgzf(header):
+    """True if the first bytes of a file are a BGZF block header (gzip with a 'BC' extra field)."""
+    return len(header) >= 16 and header[:4] == b'\x1f\x8b\x08\x04' and header[12:14] == b'BC'
+
+def gunzip(src, dest, workers=None):
+    """Decompress src to dest."""
+    with open_stream(src, workers) as f_in:
+        with open(dest, 'wb') as f_out:
+            shutil.copyfileobj(f_in, f_out, READ_SIZE)
+
+class _BgzfReader(io.RawIOBase):
+    def __init__(self, fh, workers):
+        self.fh = fh
+        self.pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+        self.pending = collections.deque()
+        # Enough blocks in flight to keep every thread busy
+        self.window = workers * 4
+        self.buffer = memoryview(b'')
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self.buffer):
+            self._fill()
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+        n = min(len(buffer), len(self.buffer))
+        buffer[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.pool.shutdown(wait=True)
+            self.fh.close()
+        super().close()
+
+    def _fill(self):
+        while not self.eof and len(self.pending) < self.window:
+            block = self._read_block()
+            if block is None:
+                self.eof = True
+                break
+            self.pending.append(self.pool.submit(_inflate_block, *block))
+
+    def _read_block(self):
+        header = self.fh.read(12)
+        if not header:
+            return None
+        if len(header) < 12 or header[:2] != GZIP_MAGIC:
+            raise Exception("Corrupt BGZF block header")
+        xlen = struct.unpack('<H', header[10:12])[0]
+        extra = self.fh.read(xlen)
+        bsize = None
+        pos = 0
+        while pos + 4 <= len(extra):
+            slen = struct.unpack('<H', extra[pos + 2:pos + 4])[0]
+            if extra[pos:pos + 2] == b'BC':
+                bsize = struct.unpack('<H', extra[pos + 4:pos + 6])[0]
+            pos += 4 + slen
+        if bsize is None:
+            raise Exception("Gzip member without a BGZF block size in a BGZF file")
+        rest = self.fh.read(bsize + 1 - 12 - xlen)
+        crc, isize = struct.unpack('<II', rest[-8:])
+        return rest[:-8], crc, isize
+
+def _inflate_block(cdata, crc, isize):
+    data = zlib.decompress(cdata, -15)
+    if len(data) != isize or zlib.crc32(data) != crc:
+        raise Exception("BGZF block failed its CRC/length check")
+    return data
+
+class _ReadaheadReader(io.RawIOBase):
+    def __init__(self, fh, source):
+        self.fh = fh
+        self.source = source
+        self.chunks = queue.Queue(maxsize=READAHEAD)
+        self.stop = threading.Event()
+        self.buffer = memoryview(b'')
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not len(self.buffer):
+            chunk = self.chunks.get()
+            if isinstance(chunk, Exception):
+                # Leave the error for any later read too, rather than blocking on an empty queue
+                self.chunks.put(chunk)
+                raise chunk
+            if chunk is None:
+                # Leave the end marker for any later read
+                self.chunks.put(None)
+                return 0
+            self.buffer = memoryview(chunk)
+        n = min(len(buffer), len(self.buffer))
+        buffer[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.stop.set()
+            # Unblock the producer if it is waiting on a full queue
+            while self.thread.is_alive():
+                try:
+                    self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            self.fh.close()
+            self.source.close()
+        super().close()
+
+    def _produce(self):
+        try:
+            while not self.stop.is_set():
+                chunk = self.fh.read(READ_SIZE)
+                if not chunk:
+                    break
+                self.chunks.put(chunk)
+            self.chunks.put(None)
+        except Exception as err:
+            self.chunks.put(err)
@@ -0,0 +1,182 @@
+"""
+Reads MEX and 3tab expression bundles straight out of a tarball.
+
+Members are parsed from the tarfile stream as they go by (decompressing gzipped members
+inline, see parallelgzip.py) and the sparse AnnData is assembled in memory, so the expression matrix never
+touches the disk.
+
+    adata, bundle_type = tarstreamer.read_bundle('/path/to/DLPFCcon322polyAgeneLIBD.mex.tar.gz')
+
+"""
+
+import io
+import os
+import tarfile
+
+import anndata
+import pandas as pd
+
+import mexparser
+import parallelgzip
+import threetabparser
+
+# Basename suffixes (after any .gz is dropped) identifying each member of a bundle
+MEX_ROLES = {
+    'matrix.mtx': 'matrix',
+    'barcodes.tsv': 'barcodes',
+    'genes.tsv': 'genes',
+    'features.tsv': 'genes',
+}
+
+THREETAB_ROLES = {
+    '_DataMTX.tab': 'data',
+    '_COLmeta.tab': 'obs',
+    '_ROWmeta.tab': 'var',
+    # Naming used by gEAR's upload tool
+    'expression.tab': 'data',
+    'observations.tab': 'obs',
+    'genes.tab': 'var',
+}
+
+
+def member_role(name):
+    """
+    Input: A tar member name, like 'DLPFCcon322polyAgeneLIBD/DLPFCcon322polyAgeneLIBD_matrix.mtx.gz'
+
+    Output: A (bundle_type, role) tuple such as ('mex', 'matrix') or ('3tab', 'obs').
+           (None, None) is returned for members which aren't part of the expression data,
+           like the EXPmeta JSON.
+    """
+    basename = os.path.basename(name)
+    if basename.endswith('.gz'):
+        basename = basename[:-3]
+    for suffix, role in MEX_ROLES.items():
+        if basename.endswith(suffix):
+            return 'mex', role
+    for suffix, role in THREETAB_ROLES.items():
+        if basename.endswith(suffix):
+            return '3tab', role
+    return None, None
+
+class MemberStream(io.RawIOBase):
+    """
+    Forward-only wrapper around a member of a tarfile opened in stream ('r|') mode.
+
+    The file objects tarfile hands back in stream mode don't implement seekable(), which
+    pandas and io.TextIOWrapper insist on asking about.
+    """
+    def __init__(self, fh):
+        self.fh = fh
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return False
+
+    def readinto(self, buffer):
+        data = self.fh.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+def open_member(tf, member):
+    """Return a readable binary stream for a tar member, decompressing it inline if gzipped."""
+    return _inflate(member.name, io.BufferedReader(MemberStream(tf.extractfile(member))))
+
+def _inflate(name, fh):
+    if name.endswith('.gz'):
+        return parallelgzip.open_stream(fh)
+    return fh
+
+def read_bundle(filepath, index=None):
+    """
+    Input: Path to a .tar or .tar.gz bundle containing either MEX or 3tab files, and
+           optionally its archiveinspector.ArchiveIndex.
+
+    Output: An (adata, bundle_type) tuple where bundle_type is 'mex' or '3tab'.  adata is
+           None (and bundle_type None) if no expression files were found.
+
+    With a complete index of an uncompressed tar, each expression member is read by
+    seeking straight to its data.  Otherwise the tarball is read in streaming mode, so
+    each member is parsed exactly once, in archive order, without seeking or extracting.
+    """
+    parts = dict()
+    bundle_type = None
+
+    def add_part(name, open_fn):
+        nonlocal bundle_type
+        member_type, role = member_role(name)
+        if role is None:
+            return
+        if bundle_type and member_type != bundle_type:
+            raise Exception("Tarball {0} mixes MEX and 3tab members".format(filepath))
+        bundle_type = member_type
+        with open_fn() as fh:
+            parts[role] = READERS[role](fh)
+
+    if index is not None and index.seekable():
+        for entry in index.members:
+            add_part(entry.name, lambda: _inflate(entry.name, index.open(entry)))
+    else:
+        # A .tar.gz is inflated on its own thread (block parallel for BGZF) while members are parsed
+        with parallelgzip.open_stream(filepath) as fh, tarfile.open(fileobj=fh, mode='r|') as tf:
+            for member in tf:
+                if member.isfile():
+                    add_part(member.name, lambda: open_member(tf, member))
+
+    if bundle_type == 'mex':
+        return build_mex_adata(parts, filepath), bundle_type
+    if bundle_type == '3tab':
+        return build_3tab_adata(parts, filepath), bundle_type
+    return None, None
+
+def read_mex(filepath):
+    """Read a MEX tarball into an AnnData (cells x genes)."""
+    adata, bundle_type = read_bundle(filepath)
+    if bundle_type != 'mex':
+        raise Exception("Tarball {0} does not contain MEX files".format(filepath))
+    return adata
+
+def has_ensembl_index(adata):
+    """True if the AnnData's var index is made of Ensembl IDs rather than gene symbols."""
+    return bool(len(adata.var.index)) and bool(adata.var.index.astype(str).str.startswith('ENS').all())
+
+def build_mex_adata(parts, filepath):
+    _require(parts, ['matrix', 'barcodes', 'genes'], filepath)
+    X = parts['matrix']
+    obs = parts['barcodes']
+    var = parts['genes']
+    return anndata.AnnData(X=X, obs=obs, var=var)
+
+def build_3tab_adata(parts, filepath):
+    _require(parts, ['data', 'obs', 'var'], filepath)
+    data = parts['data']
+    # threetabparser has already flipped DataMTX (genes x cells) to cells x genes
+    obs = parts['obs'].reindex(data.cells)
+    var = parts['var'].reindex(data.genes)
+    return anndata.AnnData(X=data.X, obs=obs, var=var)
+
+def _require(parts, roles, filepath):
+    missing = [role for role in roles if role not in parts]
+    if missing:
+        raise Exception("Tarball {0} is missing required files: {1}".format(filepath, ", ".join(missing)))
+
+def _read_mtx(fh):
+    # matrix.mtx is genes x cells.  mexparser builds the cells x genes CSR directly.
+    return mexparser.read_mtx(fh)
+
+def _read_barcodes(fh):
+    return pd.read_csv(fh, sep='\t', index_col=0, header=None, names=['observations'], dtype=str)
+
+def _read_genes(fh):
+    # 10x v3 features.tsv carries a third 'feature type' column which we don't keep
+    return pd.read_csv(fh, sep='\t', index_col=0, header=None, usecols=[0, 1], names=['genes', 'gene_symbol'], dtype=str)
+
+READERS = {
+    'matrix': _read_mtx,
+    'barcodes': _read_barcodes,
+    'genes': _read_genes,
+    'data': threetabparser.read_data_matrix,
+    'obs': threetabparser.read_metadata,
+    'var': threetabparser.read_metadata,
+}
@@ -0,0 +1,138 @@
+"""
+Reads the expression table of a 3tab bundle (_DataMTX.tab: genes x cells, tab separated,
+a header row of cell IDs and a leading column of gene IDs) into a cells x genes matrix
+without ever holding it as a dense float64 table.
+
+The text is cut into blocks of whole lines which are parsed by pandas' C parser on a
+pool of threads while the next blocks are being read.  Each parsed block (genes x cells)
+is converted straight away into the matrix's final form:
+
+  * sparse - if the first block's density is at or below SPARSE_THRESHOLD, every block
+             becomes a CSR block and only non-zero values are kept.  Counts matrices are
+             mostly zeros, so this is the usual case.
+  * dense  - otherwise each block is kept dense, but in the narrowest dtype holding its
+             values exactly (integer counts as small integers, real values as float32
+             when that loses nothing).
+
+Either way, whole-number counts end up in the smallest integer dtype that holds them (see
+mexparser.narrow_values), checked per block for dense data and over the non-zero values
+for sparse.
+
+COLmeta/ROWmeta are read with string columns that repeat a lot (cell types, clusters,
+conditions...) stored as categoricals.
+
+    with open('dataset_DataMTX.tab', 'rb') as fh:
+        X, cells, genes = threetabparser.read_data_matrix(fh)
+
+"""
+
+import collections
+import concurrent.futures
+import csv
+import io
+import os
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+from mexparser import narrow_values
+
+# Bytes of text per parsed block
+BLOCK_BYTES = 16 * 1024 * 1024
+# Blocks at or below this fraction of non-zero values are stored sparse
+SPARSE_THRESHOLD = 0.5
+# Object columns with at most this fraction of distinct values become categoricals
+CATEGORY_THRESHOLD = 0.5
+
+ThreeTabMatrix = collections.namedtuple('ThreeTabMatrix', ['X', 'cells', 'genes'])
+
+
+def read_data_matrix(fh, block_bytes=BLOCK_BYTES, workers=None):
+    """
+    Input: A binary file object over a DataMTX table (genes x cells), and optionally the
+           block size and number of parsing threads.
+
+    Output: A ThreeTabMatrix of (X, cells, genes), with X cells x genes as CSR (sparse
+           data) or a numpy array (dense data), and the cell and gene IDs as pandas Indexes.
+    """
+    workers = workers or min(8, os.cpu_count() or 1)
+    header = _split(fh.readline())
+
+    genes = list()
+    blocks = list()
+    sparse = None
+    pending = collections.deque()
+    cells = None
+    dtypes = None
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            lines = fh.readlines(block_bytes)
+            if lines and cells is None:
+                # R's write.table leaves the corner cell off the header row, others don't
+                n_fields = len(_split(lines[0]))
+                cells = header if len(header) == n_fields - 1 else header[1:]
+                dtypes = {i + 1: np.float64 for i in range(len(cells))}
+                dtypes[0] = str
+            if lines:
+                pending.append(pool.submit(_parse_block, b''.join(_encode(l) for l in lines), dtypes))
+            # Keep a few blocks parsing ahead of the one being converted
+            while pending and (len(pending) > workers or not lines):
+                block_genes, values = pending.popleft().result()
+                if sparse is None:
+                    sparse = np.count_nonzero(values) <= SPARSE_THRESHOLD * max(values.size, 1)
+                genes.append(block_genes)
+                blocks.append(scipy.sparse.csr_matrix(values) if sparse else narrow_values(values))
+            if not lines:
+                break
+
+    if cells is None:
+        raise Exception("DataMTX table has no rows")
+    cells = pd.Index(cells)
+    genes = pd.Index(np.concatenate(genes)) if genes else pd.Index([])
+
+    if sparse:
+        # genes x cells CSR -> cells x genes CSR
+        X = scipy.sparse.vstack(blocks, format='csr').T.tocsr()
+        del blocks
+        X.data = narrow_values(X.data)
+    else:
+        dtype = np.result_type(*blocks)
+        X = np.empty((len(cells), len(genes)), dtype=dtype)
+        start = 0
+        while blocks:
+            block = blocks.pop(0)
+            X[:, start:start + block.shape[0]] = block.T
+            start += block.shape[0]
+    return ThreeTabMatrix(X, cells, genes)
+
+def read_metadata(fh):
+    """
+    Input: A binary file object over a COLmeta or ROWmeta table.
+
+    Output: A DataFrame indexed by the first column, with repetitive string columns as
+           categoricals.
+    """
+    df = pd.read_csv(fh, sep='\t', index_col=0, header=0)
+    df.index = df.index.astype(str)
+    for column in df.columns:
+        values = df[column]
+        if pd.api.types.is_string_dtype(values) and values.nunique() <= CATEGORY_THRESHOLD * len(values):
+            df[column] = values.astype('category')
+    return df
+
+def _parse_block(block, dtypes):
+    df = pd.read_csv(io.BytesIO(block), sep='\t', header=None, index_col=0, dtype=dtypes, engine='c')
+    return df.index.values.astype(str), df.values
+
+def _split(line):
+    # Same quoting rules as pandas applies to the body, so quoted IDs (write.table's
+    # default) come out the same in the header as in the rows
+    return next(csv.reader([_decode(line).rstrip('\r\n')], delimiter='\t'))
+
+def _decode(line):
+    return line.decode() if isinstance(line, bytes) else line
+
+def _encode(line):
+    return line.encode() if isinstance(line, str) else line